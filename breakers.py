@@ -0,0 +1,121 @@
+"""
+breakers.py - Circuit Breakers for Failing Logins and Sources
+--------------------------------------------------------------
+This module stops the scheduler from retrying a login or a source that
+keeps failing (wrong password, deleted or private source) on every cycle:
+- Each failure opens the breaker for an exponentially growing backoff.
+- While open, attempts are skipped for free and counted as suppressed.
+- Once the backoff expires, a single probe attempt is let through
+  (half-open); success closes the breaker, failure reopens it for longer.
+  A probe that ends without either (e.g. it was cut short by something
+  unrelated to the key) must be released with release_probe(), and one
+  that is never released expires after PROBE_TIMEOUT.
+State lives in the settings database so the bot can show it in View Logs.
+"""
+
+import time
+import logging
+import threading
+from storage import DB_FILE, connect
+
+logger = logging.getLogger(__name__)
+
+BASE_BACKOFF = 5 * 60
+MAX_BACKOFF = 24 * 60 * 60
+# Seconds after which an unfinished half-open probe no longer blocks others.
+PROBE_TIMEOUT = 10 * 60
+
+
+def login_key(user_id: str) -> str:
+    """Breaker key for a user's Instagram login."""
+    return "login:%s" % user_id
+
+
+def source_key(source: str) -> str:
+    """Breaker key for a source account, shared by every user polling it."""
+    return "source:%s" % source.lower()
+
+
+class CircuitBreakers:
+    """Persistent breakers keyed by strings such as login_key() and source_key()."""
+
+    def __init__(self, path: str = DB_FILE):
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS circuit_breakers ("
+            " key TEXT PRIMARY KEY,"
+            " failures INTEGER NOT NULL,"
+            " open_until REAL NOT NULL,"
+            " suppressed INTEGER NOT NULL DEFAULT 0,"
+            " last_error TEXT)"
+        )
+        self.probing = {}  # Key -> start (time.monotonic()) of a half-open probe in this process
+
+    def allow(self, key: str) -> bool:
+        """Return True if an attempt may run now; count it as suppressed otherwise."""
+        now = time.time()
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT open_until FROM circuit_breakers WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return True
+            probe_started = self.probing.get(key)
+            if now >= row[0] and (
+                probe_started is None or time.monotonic() - probe_started >= PROBE_TIMEOUT
+            ):
+                self.probing[key] = time.monotonic()  # Half-open: let one probe through
+                return True
+            self.conn.execute(
+                "UPDATE circuit_breakers SET suppressed = suppressed + 1 WHERE key = ?", (key,)
+            )
+            return False
+
+    def record_success(self, key: str):
+        """Close the breaker after a successful attempt."""
+        with self.lock:
+            self.probing.pop(key, None)
+            if self.conn.execute(
+                "SELECT 1 FROM circuit_breakers WHERE key = ?", (key,)
+            ).fetchone():
+                self.conn.execute("DELETE FROM circuit_breakers WHERE key = ?", (key,))
+
+    def record_failure(self, key: str, error):
+        """Open (or reopen) the breaker with exponential backoff."""
+        now = time.time()
+        with self.lock:
+            self.probing.pop(key, None)
+            row = self.conn.execute(
+                "SELECT failures FROM circuit_breakers WHERE key = ?", (key,)
+            ).fetchone()
+            failures = (row[0] if row else 0) + 1
+            backoff = min(MAX_BACKOFF, BASE_BACKOFF * 2 ** (failures - 1))
+            self.conn.execute(
+                "INSERT INTO circuit_breakers (key, failures, open_until, suppressed, last_error) "
+                "VALUES (?, ?, ?, 0, ?) "
+                "ON CONFLICT(key) DO UPDATE SET failures = excluded.failures, "
+                "open_until = excluded.open_until, last_error = excluded.last_error",
+                (key, failures, now + backoff, str(error)[:200]),
+            )
+        logger.warning("%s failed %d time(s); retrying in %ds: %s", key, failures, backoff, error)
+
+    def release_probe(self, key: str):
+        """
+        End a half-open probe whose outcome says nothing about the key (e.g.
+        the caller was throttled), so the next attempt may probe again.
+        Harmless when no probe is in flight.
+        """
+        with self.lock:
+            self.probing.pop(key, None)
+
+    def status(self, keys: list) -> list:
+        """Return (key, failures, open_until, suppressed, last_error) for the open breakers among keys."""
+        if not keys:
+            return []
+        with self.lock:
+            return self.conn.execute(
+                "SELECT key, failures, open_until, suppressed, last_error FROM circuit_breakers "
+                "WHERE key IN (%s) ORDER BY key" % ", ".join("?" * len(keys)),
+                keys,
+            ).fetchall()
@@ -0,0 +1,106 @@
+"""
+client_pool.py - Pool of Live Instagram Clients
+------------------------------------------------
+This module keeps authenticated instagrapi Client objects in memory between
+scheduler cycles, so active users keep a warm client (and its HTTP
+keep-alive connections) instead of having one rebuilt every cycle:
+- Keyed by user id, and tied to the credentials and proxy it was built with.
+- Least recently used clients are evicted once the pool is full.
+- Clients idle for longer than the TTL are evicted and their connections closed.
+A Client keeps per-request state (last_json, last_response) and is not
+thread-safe; client_lock() returns the lock every API call on it must hold,
+since a pooled client is shared by the repost stages and the resolver.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Maximum clients kept alive. Each client holds its own HTTP sessions and
+# session state, so this bounds the pool's memory.
+CLIENT_POOL_SIZE = int(os.environ.get("CLIENT_POOL_SIZE", "100"))
+# Seconds a client may sit unused before it is evicted.
+CLIENT_IDLE_TTL = float(os.environ.get("CLIENT_IDLE_TTL", str(3 * 60 * 60)))
+
+
+def client_lock(client) -> threading.Lock:
+    """Return the lock serializing API calls on a client, creating it on first use."""
+    return vars(client).setdefault("_api_lock", threading.Lock())
+
+
+def close_client(client):
+    """Close the HTTP sessions held by an instagrapi client."""
+    for name in ("private", "public"):
+        session = getattr(client, name, None)
+        if session is not None:
+            try:
+                session.close()
+            except Exception as e:
+                logger.debug("Error closing %s session: %s", name, e)
+
+
+class ClientPool:
+    """Bounded LRU of logged-in clients with idle eviction."""
+
+    def __init__(self, max_size: int = CLIENT_POOL_SIZE, idle_ttl: float = CLIENT_IDLE_TTL):
+        self.max_size = max_size
+        self.idle_ttl = idle_ttl
+        self.lock = threading.Lock()
+        # user_id -> (fingerprint, client, last_used)
+        self.clients = OrderedDict()
+
+    def get(self, user_id: str, fingerprint: tuple):
+        """
+        Return the pooled client for a user, or None.
+        A client built for different credentials or proxy is discarded.
+        """
+        with self.lock:
+            self._evict_idle()
+            entry = self.clients.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] != fingerprint:
+                del self.clients[user_id]
+                stale = entry[1]
+            else:
+                self.clients[user_id] = (fingerprint, entry[1], time.monotonic())
+                self.clients.move_to_end(user_id)
+                return entry[1]
+        close_client(stale)
+        return None
+
+    def put(self, user_id: str, fingerprint: tuple, client):
+        """Add or replace a user's client, evicting the least recently used if full."""
+        evicted = []
+        with self.lock:
+            previous = self.clients.pop(user_id, None)
+            if previous is not None and previous[1] is not client:
+                evicted.append(previous[1])
+            self.clients[user_id] = (fingerprint, client, time.monotonic())
+            while len(self.clients) > self.max_size:
+                _, (_, lru_client, _) = self.clients.popitem(last=False)
+                evicted.append(lru_client)
+        for stale in evicted:
+            close_client(stale)
+
+    def discard(self, user_id: str):
+        """Remove a user's client, e.g. after its session was rejected."""
+        with self.lock:
+            entry = self.clients.pop(user_id, None)
+        if entry is not None:
+            close_client(entry[1])
+
+    def _evict_idle(self):
+        """Drop clients unused for longer than idle_ttl; the caller holds the lock."""
+        cutoff = time.monotonic() - self.idle_ttl
+        while self.clients:
+            user_id, (_, client, last_used) = next(iter(self.clients.items()))
+            if last_used >= cutoff:
+                break
+            del self.clients[user_id]
+            close_client(client)
+            logger.info("Evicted idle Instagram client for user %s", user_id)
@@ -0,0 +1,183 @@
+"""
+fake_telegram.py - Offline Webhook Load Harness
+------------------------------------------------
+This script stands in for Telegram so webhook throughput can be measured
+without network access:
+1. It serves a fake Bot API that answers every method the bot calls
+   (getMe, setWebhook, sendMessage, editMessageText, answerCallbackQuery...)
+   and counts the calls.
+2. Once the bot has registered its webhook, it POSTs synthetic /start
+   commands and button presses to the webhook with the secret token
+   header, from several concurrent senders.
+3. It reports how fast the updates were accepted and how long the bot took
+   to answer all of them through the fake API.
+
+Example, with the bot using a throwaway settings database:
+
+    python fake_telegram.py --updates 2000 &
+    SETTINGS_DB=/tmp/load.db TELEGRAM_TOKEN=123:fake \\
+    TELEGRAM_API_URL=http://127.0.0.1:8081/bot \\
+    TELEGRAM_WEBHOOK_URL=http://127.0.0.1:5000 TELEGRAM_WEBHOOK_SECRET=secret \\
+    PORT=5000 python server.py
+"""
+
+import json
+import time
+import argparse
+import threading
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Reposter", "username": "reposter_bot"}
+
+# Bot API methods that answer an update; each update gets exactly one.
+REPLY_METHODS = ("sendMessage", "editMessageText")
+
+
+class FakeBotAPI:
+    """Counts Bot API calls and signals when the webhook is set and replies arrive."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.replies = 0
+        self.webhook_set = threading.Event()
+        self.replies_done = threading.Event()
+        self.expected_replies = None
+
+    def handle(self, method: str, params: dict):
+        """Record a call and return its result."""
+        with self.lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            if method in REPLY_METHODS:
+                self.replies += 1
+                if self.expected_replies is not None and self.replies >= self.expected_replies:
+                    self.replies_done.set()
+        if method == "getMe":
+            return dict(BOT_USER, can_join_groups=False, can_read_all_group_messages=False,
+                        supports_inline_queries=False)
+        if method == "setWebhook":
+            self.webhook_set.set()
+            return True
+        if method in REPLY_METHODS:
+            chat_id = int(params.get("chat_id") or 0)
+            return {
+                "message_id": int(params.get("message_id") or 1),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": BOT_USER,
+                "text": params.get("text", ""),
+            }
+        return True
+
+    def server(self, port: int) -> ThreadingHTTPServer:
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                raw = self.rfile.read(length) if length else b""
+                if self.headers.get("Content-Type", "").startswith("application/json"):
+                    params = json.loads(raw or b"{}")
+                else:
+                    params = dict(urllib.parse.parse_qsl(raw.decode()))
+                method = self.path.rstrip("/").rsplit("/", 1)[-1]
+                body = json.dumps({"ok": True, "result": api.handle(method, params)}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST
+
+            def log_message(self, format, *args):
+                pass
+
+        return ThreadingHTTPServer(("127.0.0.1", port), Handler)
+
+
+def make_update(update_id: int, user_id: int) -> dict:
+    """Alternate /start commands and Reposting Settings button presses."""
+    sender = {"id": user_id, "is_bot": False, "first_name": "Load%d" % user_id}
+    chat = {"id": user_id, "type": "private"}
+    if update_id % 2:
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id, "date": int(time.time()), "chat": chat, "from": sender,
+                "text": "/start", "entities": [{"type": "bot_command", "offset": 0, "length": 6}],
+            },
+        }
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": sender, "chat_instance": str(user_id),
+            "data": "reposting_settings",
+            "message": {
+                "message_id": update_id, "date": int(time.time()), "chat": chat,
+                "from": BOT_USER, "text": "menu",
+            },
+        },
+    }
+
+
+def post_update(webhook: str, secret: str, update: dict) -> float:
+    """POST one update to the webhook and return the request latency."""
+    request = urllib.request.Request(
+        webhook, data=json.dumps(update).encode(), method="POST",
+        headers={"Content-Type": "application/json",
+                 "X-Telegram-Bot-Api-Secret-Token": secret},
+    )
+    started = time.perf_counter()
+    with urllib.request.urlopen(request, timeout=30) as response:
+        response.read()
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--api-port", type=int, default=8081, help="port for the fake Bot API")
+    parser.add_argument("--webhook", default="http://127.0.0.1:5000/telegram",
+                        help="bot webhook URL to post updates to")
+    parser.add_argument("--secret", default="secret", help="webhook secret token")
+    parser.add_argument("--updates", type=int, default=1000, help="number of updates to send")
+    parser.add_argument("--users", type=int, default=50, help="distinct users sending them")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent senders")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds to wait for replies")
+    args = parser.parse_args()
+
+    api = FakeBotAPI()
+    server = api.server(args.api_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print("Fake Bot API on http://127.0.0.1:%d/bot - waiting for setWebhook" % args.api_port)
+    api.webhook_set.wait()
+    time.sleep(0.5)  # Let the bot finish starting after registering its webhook
+
+    with api.lock:
+        api.expected_replies = api.replies + args.updates
+    updates = [make_update(i, 1000 + i % args.users) for i in range(1, args.updates + 1)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as senders:
+        latencies = sorted(senders.map(lambda update: post_update(args.webhook, args.secret, update), updates))
+    accepted = time.perf_counter() - started
+    answered = api.replies_done.wait(args.timeout)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+
+    print("Accepted %d updates in %.2fs (%.0f updates/s)" % (
+        len(latencies), accepted, len(latencies) / accepted))
+    print("Webhook latency p50 %.1fms, p99 %.1fms" % (
+        latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99) - 1] * 1000))
+    if answered:
+        print("All updates answered in %.2fs (%.0f updates/s)" % (elapsed, args.updates / elapsed))
+    else:
+        print("Only %d of %d updates answered within %.0fs" % (
+            api.replies - (api.expected_replies - args.updates), args.updates, args.timeout))
+    print("Bot API calls: %s" % ", ".join("%s=%d" % item for item in sorted(api.calls.items())))
+
+
+if __name__ == "__main__":
+    main()
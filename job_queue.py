@@ -0,0 +1,165 @@
+"""
+job_queue.py - Durable Repost Job Queue
+----------------------------------------
+This module records every (user, source, media) repost as a job in the
+settings database, so work survives a restart of the scheduler:
+- Jobs move through pending -> downloading -> uploading -> done, or end as
+  failed after MAX_ATTEMPTS errors.
+- A worker claims a job with a lease before working on it. Every claim
+  gets its own lease token, so no other worker, whether a thread of this
+  process or another process, can take the job until the lease expires,
+  and a worker whose lease was taken over cannot release or fail the job.
+- After a crash, unfinished jobs are picked up again by the next run of the
+  same user once their lease has run out.
+The media itself is stored with the job as JSON, so a job can be resumed
+without fetching the source again.
+"""
+
+import os
+import time
+import uuid
+import itertools
+import socket
+import logging
+import threading
+from storage import DB_FILE, connect
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+DOWNLOADING = "downloading"
+UPLOADING = "uploading"
+DONE = "done"
+FAILED = "failed"
+UNFINISHED = (PENDING, DOWNLOADING, UPLOADING)
+
+# Seconds a claimed job stays reserved for the worker that claimed it.
+JOB_LEASE = float(os.environ.get("JOB_LEASE", "600"))
+# Errors after which a job is given up on.
+MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", "3"))
+# Seconds finished jobs are kept before they are purged.
+JOB_RETENTION = 7 * 24 * 60 * 60
+
+
+class JobQueue:
+    """Persistent repost jobs with leases, keyed by (user, source, media pk)."""
+
+    def __init__(self, path: str = DB_FILE):
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS repost_jobs ("
+            " id INTEGER PRIMARY KEY,"
+            " user_id TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " media_pk TEXT NOT NULL,"
+            " taken_at REAL NOT NULL,"
+            " payload TEXT NOT NULL,"
+            " state TEXT NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " lease_owner TEXT,"
+            " lease_until REAL NOT NULL DEFAULT 0,"
+            " error TEXT,"
+            " updated_at REAL NOT NULL,"
+            " UNIQUE (user_id, source, media_pk))"
+        )
+        # Prefix of this process's lease tokens; unique per start, so a
+        # restarted process never mistakes a lease from its previous life for
+        # its own. Each claim appends its own number.
+        self.owner = "%s:%d:%s" % (socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+        self.claims = itertools.count(1)
+
+    def enqueue(self, user_id: str, source: str, media_pk, taken_at: float, payload: str):
+        """Add a job unless it already exists; return its (id, state)."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO repost_jobs (user_id, source, media_pk, taken_at, payload, state, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+                (user_id, source, str(media_pk), taken_at, payload, PENDING, time.time()),
+            )
+            return self.conn.execute(
+                "SELECT id, state FROM repost_jobs WHERE user_id = ? AND source = ? AND media_pk = ?",
+                (user_id, source, str(media_pk)),
+            ).fetchone()
+
+    def unfinished(self, user_id: str, source: str) -> list:
+        """Return (media_pk, payload) for a user's unfinished jobs from a source, oldest first."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT media_pk, payload FROM repost_jobs "
+                "WHERE user_id = ? AND source = ? AND state IN (?, ?, ?) ORDER BY taken_at",
+                (user_id, source) + UNFINISHED,
+            ).fetchall()
+
+    def claim(self, job_id: int, state: str, lease: str = None):
+        """
+        Move an unfinished job to `state` under a fresh lease and return the
+        lease token. Passing the token of a lease still held renews it.
+        Returns None if the job is finished or leased by another worker.
+        """
+        now = time.time()
+        token = lease or "%s:%d" % (self.owner, next(self.claims))
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE repost_jobs SET state = ?, lease_owner = ?, lease_until = ?, updated_at = ? "
+                "WHERE id = ? AND state IN (?, ?, ?) "
+                "AND (lease_owner IS NULL OR lease_owner = ? OR lease_until < ?)",
+                (state, token, now + JOB_LEASE, now, job_id) + UNFINISHED + (token, now),
+            )
+            return token if cursor.rowcount == 1 else None
+
+    def complete(self, job_id: int):
+        """Mark a job done, whoever holds its lease: the work is finished either way."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE repost_jobs SET state = ?, lease_owner = NULL, lease_until = 0, "
+                "error = NULL, updated_at = ? WHERE id = ?",
+                (DONE, time.time(), job_id),
+            )
+
+    def complete_media(self, user_id: str, source: str, media_pk):
+        """Mark the job for a media item done, if there is one (e.g. it no longer needs reposting)."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE repost_jobs SET state = ?, lease_owner = NULL, lease_until = 0, updated_at = ? "
+                "WHERE user_id = ? AND source = ? AND media_pk = ? AND state IN (?, ?, ?)",
+                (DONE, time.time(), user_id, source, str(media_pk)) + UNFINISHED,
+            )
+
+    def release(self, job_id: int, lease: str):
+        """
+        Return a claimed job to pending without counting an attempt (e.g. the
+        session expired). Does nothing if `lease` no longer holds the job.
+        """
+        with self.lock:
+            self.conn.execute(
+                "UPDATE repost_jobs SET state = ?, lease_owner = NULL, lease_until = 0, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ?",
+                (PENDING, time.time(), job_id, lease),
+            )
+
+    def fail(self, job_id: int, lease: str, error):
+        """
+        Record a failed attempt. The job goes back to pending, or to failed
+        once it has used up MAX_ATTEMPTS. Returns the new state, or None if
+        `lease` no longer holds the job and nothing was recorded.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "UPDATE repost_jobs SET attempts = attempts + 1, "
+                "state = CASE WHEN attempts + 1 >= ? THEN ? ELSE ? END, "
+                "lease_owner = NULL, lease_until = 0, error = ?, updated_at = ? "
+                "WHERE id = ? AND lease_owner = ? RETURNING state",
+                (MAX_ATTEMPTS, FAILED, PENDING, str(error)[:200], time.time(), job_id, lease),
+            ).fetchone()
+        return row[0] if row else None
+
+    def purge(self, retention: float = JOB_RETENTION):
+        """Delete done and failed jobs last updated more than `retention` seconds ago."""
+        with self.lock:
+            cursor = self.conn.execute(
+                "DELETE FROM repost_jobs WHERE state IN (?, ?) AND updated_at < ?",
+                (DONE, FAILED, time.time() - retention),
+            )
+        if cursor.rowcount:
+            logger.info("Purged %d finished repost jobs", cursor.rowcount)
@@ -0,0 +1,43 @@
+"""
+keyboards.py - Memoized Inline Keyboards
+-----------------------------------------
+Menu keyboards depend only on a few settings (a toggle or two, the repost
+interval), yet were rebuilt on every button press. This module caches the
+built InlineKeyboardMarkup per (menu id, state tuple) in a small LRU, so a
+menu is built once per distinct state and then reused. Keyboard markups are
+immutable in python-telegram-bot, so sharing one between users is safe.
+"""
+
+import threading
+from collections import OrderedDict
+
+# Distinct (menu, state) keyboards kept; each is a handful of buttons.
+KEYBOARD_CACHE_SIZE = 256
+
+
+class KeyboardCache:
+    """Bounded LRU of built keyboards keyed by (menu id, state tuple)."""
+
+    def __init__(self, maxsize: int = KEYBOARD_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, menu: str, state: tuple, build):
+        """Return the keyboard for a menu in a given state, calling build(*state) on a miss."""
+        key = (menu, state)
+        with self.lock:
+            markup = self.entries.get(key)
+            if markup is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return markup
+            self.misses += 1
+        markup = build(*state)
+        with self.lock:
+            self.entries[key] = markup
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return markup
@@ -8,12 +8,14 @@ This script initializes the Telegram bot that lets you:
 - Toggle which content types (Reels, Photos, Carousels) to repost.
 - View logs and monitor activity.
 
+Updates arrive by long polling, or by webhook when TELEGRAM_WEBHOOK_URL is set.
+
 Before running, install dependencies via requirements.txt.
 """
 
 import os
-import json
 import logging
+import importlib.util
 from datetime import datetime
 from telegram import (
     Update,
@@ -28,23 +30,29 @@ from telegram.ext import (
     filters,
     ContextTypes,
 )
+from storage import get_store
+from source_ids import SourceIdCache
+from breakers import CircuitBreakers, login_key, source_key
+from router import CallbackRouter
+from keyboards import KeyboardCache
 
 # ----------------------------
 # SETTINGS STORAGE
 # ----------------------------
 
-SETTINGS_FILE = "user_settings.json"
-# For demo purposes we use a JSON file. In production, use a secure database.
-if os.path.exists(SETTINGS_FILE):
-    with open(SETTINGS_FILE, "r") as file:
-        user_settings = json.load(file)
-else:
-    user_settings = {}
+# Settings live in a local SQLite database with one row per user (see storage.py).
+store = get_store()
+user_settings = store.users
+source_ids = SourceIdCache()
+breakers = CircuitBreakers()
 
-def save_settings():
-    """Save user settings to the JSON file."""
-    with open(SETTINGS_FILE, "w") as file:
-        json.dump(user_settings, file, indent=4)
+def save_settings(user_id: str):
+    """
+    Queue a single user's settings to be persisted.
+    Writes happen in the background shortly afterwards, so several changes
+    made while handling one interaction cost a single disk write.
+    """
+    store.mark_dirty(user_id, user_settings[user_id])
 
 def get_user_settings(user_id: str):
     """Retrieve or initialize settings for a given user."""
@@ -67,9 +75,23 @@ def get_user_settings(user_id: str):
             "awaiting_source": False,           # Flag to indicate expecting a new source account
             "awaiting_account": False           # Flag to indicate expecting Instagram credentials
         }
-        save_settings()
+        save_settings(user_id)
     return user_settings[user_id]
 
+# ----------------------------
+# TELEGRAM CONNECTION
+# ----------------------------
+
+# Public base URL Telegram posts updates to (e.g. https://<app>.herokuapp.com);
+# webhook mode is used when set, long polling otherwise.
+WEBHOOK_URL = os.environ.get("TELEGRAM_WEBHOOK_URL")
+WEBHOOK_PATH = os.environ.get("TELEGRAM_WEBHOOK_PATH", "/telegram")
+# Telegram sends this back in a header with every update, so forged posts are rejected.
+WEBHOOK_SECRET = os.environ.get("TELEGRAM_WEBHOOK_SECRET")
+LISTEN_ADDR = os.environ.get("LISTEN_ADDR", "0.0.0.0")
+# Bot API endpoint, e.g. a local fake for load tests (see fake_telegram.py).
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
 # ----------------------------
 # LOGGER SETUP
 # ----------------------------
@@ -79,6 +101,55 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# ----------------------------
+# KEYBOARDS
+# ----------------------------
+
+# Static menus are built once; menus that reflect settings are built once per
+# distinct state and looked up from a small cache (see keyboards.py).
+START_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("Add Instagram Account", callback_data="add_account")],
+    [InlineKeyboardButton("Manage Source Accounts", callback_data="manage_sources")],
+    [InlineKeyboardButton("Reposting Settings", callback_data="reposting_settings")],
+    [InlineKeyboardButton("Content Types", callback_data="content_types_settings")],
+    [InlineKeyboardButton("View Logs", callback_data="view_logs")]
+])
+
+INTERVAL_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("1 hour", callback_data="set_interval:1"),
+     InlineKeyboardButton("2 hours", callback_data="set_interval:2")],
+    [InlineKeyboardButton("3 hours", callback_data="set_interval:3"),
+     InlineKeyboardButton("4 hours", callback_data="set_interval:4")]
+])
+
+keyboards = KeyboardCache()
+
+def build_sources_keyboard(*sources: str) -> InlineKeyboardMarkup:
+    """Source accounts menu: one remove button per source plus an add button."""
+    keyboard = []
+    for source in sources:
+        keyboard.append([InlineKeyboardButton(f"Remove {source}", callback_data=f"remove_source:{source}")])
+    keyboard.append([InlineKeyboardButton("Add New Source Account", callback_data="add_source")])
+    return InlineKeyboardMarkup(keyboard)
+
+def build_reposting_keyboard(auto_repost: bool, use_original_caption: bool, interval) -> InlineKeyboardMarkup:
+    """Reposting settings menu showing the current toggles and interval."""
+    auto_status = "ON" if auto_repost else "OFF"
+    caption_status = "Original" if use_original_caption else "Custom"
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"Auto-Repost: {auto_status}", callback_data="toggle_auto_repost")],
+        [InlineKeyboardButton(f"Caption: {caption_status}", callback_data="toggle_caption")],
+        [InlineKeyboardButton(f"Repost Interval: {interval} hour(s)", callback_data="set_interval_menu")],
+    ])
+
+def build_content_types_keyboard(reels: bool, photos: bool, carousels: bool) -> InlineKeyboardMarkup:
+    """Content types menu showing which types are turned on."""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(f"Reels: {'ON' if reels else 'OFF'}", callback_data="toggle_content:reels")],
+        [InlineKeyboardButton(f"Photos: {'ON' if photos else 'OFF'}", callback_data="toggle_content:photos")],
+        [InlineKeyboardButton(f"Carousels: {'ON' if carousels else 'OFF'}", callback_data="toggle_content:carousels")]
+    ])
+
 # ----------------------------
 # TELEGRAM HANDLERS
 # ----------------------------
@@ -100,15 +171,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "• View logs\n\n"
         "All data is stored per user."
     )
-    keyboard = [
-        [InlineKeyboardButton("Add Instagram Account", callback_data="add_account")],
-        [InlineKeyboardButton("Manage Source Accounts", callback_data="manage_sources")],
-        [InlineKeyboardButton("Reposting Settings", callback_data="reposting_settings")],
-        [InlineKeyboardButton("Content Types", callback_data="content_types_settings")],
-        [InlineKeyboardButton("View Logs", callback_data="view_logs")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(text, reply_markup=reply_markup)
+    await update.message.reply_text(text, reply_markup=START_KEYBOARD)
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
@@ -129,7 +192,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 settings["instagram_username"] = username.strip()
                 settings["instagram_password"] = password.strip()
                 settings["awaiting_account"] = False
-                save_settings()
+                save_settings(user_id)
                 await update.message.reply_text("Instagram destination account set successfully!")
             except Exception as e:
                 await update.message.reply_text("Error parsing credentials. Please use the format: username:password")
@@ -140,18 +203,28 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     # If waiting for a new source account
     if settings.get("awaiting_source", False):
         source_username = text.strip()
-        if source_username not in settings["source_accounts"]:
+        if source_ids.known_unavailable(source_username):
+            await update.message.reply_text(
+                f"Instagram account '{source_username}' does not exist or is private."
+            )
+        elif source_username not in settings["source_accounts"]:
             settings["source_accounts"].append(source_username)
-            save_settings()
+            source_ids.request(source_username)  # Resolved by the scheduler before its first poll
+            save_settings(user_id)
             await update.message.reply_text(f"Source account '{source_username}' added successfully!")
         else:
             await update.message.reply_text("This source account already exists.")
         settings["awaiting_source"] = False
-        save_settings()
+        save_settings(user_id)
         return
 
     await update.message.reply_text("Command not recognized. Use the inline buttons to navigate.")
 
+# Inline buttons are dispatched by callback_data through a table of routes.
+# Every handler receives (query, user_id, settings, arg), where arg is the
+# text after a prefix route's prefix (None for exact routes).
+router = CallbackRouter()
+
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Handles callback queries from inline buttons.
@@ -159,139 +232,138 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     query = update.callback_query
     user_id = str(query.from_user.id)
     settings = get_user_settings(user_id)
-    data = query.data
     await query.answer()  # Acknowledge button press
+    await router.dispatch(query.data, query, user_id, settings)
 
-    # ----- Add Instagram Destination Account -----
-    if data == "add_account":
-        settings["awaiting_account"] = True
-        save_settings()
-        await query.edit_message_text(
-            "Please send your Instagram destination account credentials in the format:\n\nusername:password"
-        )
-        return
-
-    # ----- Manage Source Accounts -----
-    if data == "manage_sources":
-        await manage_sources_menu(query, user_id)
-        return
-
-    if data == "add_source":
-        settings["awaiting_source"] = True
-        save_settings()
-        await query.edit_message_text("Please send the Instagram username of the source account to add:")
-        return
-
-    if data.startswith("remove_source:"):
-        source_to_remove = data.split(":", 1)[1]
-        if source_to_remove in settings["source_accounts"]:
-            settings["source_accounts"].remove(source_to_remove)
-            save_settings()
-            await query.edit_message_text(f"Removed source account: {source_to_remove}")
-        else:
-            await query.edit_message_text("Source account not found.")
-        return
-
-    # ----- Reposting Settings Menu -----
-    if data == "reposting_settings":
-        await reposting_settings_menu(query, user_id)
-        return
-
-    if data == "toggle_auto_repost":
-        settings["auto_repost"] = not settings["auto_repost"]
-        save_settings()
-        await reposting_settings_menu(query, user_id)
-        return
-
-    if data == "toggle_caption":
-        settings["use_original_caption"] = not settings["use_original_caption"]
-        save_settings()
-        await reposting_settings_menu(query, user_id)
-        return
-
-    if data.startswith("set_interval:"):
-        interval = int(data.split(":", 1)[1])
-        settings["repost_interval"] = interval
-        save_settings()
-        await reposting_settings_menu(query, user_id)
-        return
+# ----- Add Instagram Destination Account -----
 
-    # ----- Content Types Settings Menu -----
-    if data == "content_types_settings":
-        await content_types_settings_menu(query, user_id)
-        return
+@router.exact("add_account")
+async def add_account(query, user_id: str, settings: dict, arg):
+    settings["awaiting_account"] = True
+    save_settings(user_id)
+    await query.edit_message_text(
+        "Please send your Instagram destination account credentials in the format:\n\nusername:password"
+    )
 
-    if data.startswith("toggle_content:"):
-        content_type = data.split(":", 1)[1]
-        settings["supported_content"][content_type] = not settings["supported_content"][content_type]
-        save_settings()
-        await content_types_settings_menu(query, user_id)
-        return
+# ----- Manage Source Accounts -----
+
+@router.exact("manage_sources")
+async def show_manage_sources(query, user_id: str, settings: dict, arg):
+    await manage_sources_menu(query, user_id)
+
+@router.exact("add_source")
+async def add_source(query, user_id: str, settings: dict, arg):
+    settings["awaiting_source"] = True
+    save_settings(user_id)
+    await query.edit_message_text("Please send the Instagram username of the source account to add:")
+
+@router.prefix("remove_source:")
+async def remove_source(query, user_id: str, settings: dict, source_to_remove: str):
+    if source_to_remove in settings["source_accounts"]:
+        settings["source_accounts"].remove(source_to_remove)
+        save_settings(user_id)
+        await query.edit_message_text(f"Removed source account: {source_to_remove}")
+    else:
+        await query.edit_message_text("Source account not found.")
+
+# ----- Reposting Settings Menu -----
+
+@router.exact("reposting_settings")
+async def show_reposting_settings(query, user_id: str, settings: dict, arg):
+    await reposting_settings_menu(query, user_id)
+
+@router.exact("toggle_auto_repost")
+async def toggle_auto_repost(query, user_id: str, settings: dict, arg):
+    settings["auto_repost"] = not settings["auto_repost"]
+    save_settings(user_id)
+    await reposting_settings_menu(query, user_id)
+
+@router.exact("toggle_caption")
+async def toggle_caption(query, user_id: str, settings: dict, arg):
+    settings["use_original_caption"] = not settings["use_original_caption"]
+    save_settings(user_id)
+    await reposting_settings_menu(query, user_id)
+
+@router.prefix("set_interval:")
+async def set_interval(query, user_id: str, settings: dict, interval: str):
+    settings["repost_interval"] = int(interval)
+    save_settings(user_id)
+    await reposting_settings_menu(query, user_id)
+
+# ----- Content Types Settings Menu -----
+
+@router.exact("content_types_settings")
+async def show_content_types_settings(query, user_id: str, settings: dict, arg):
+    await content_types_settings_menu(query, user_id)
+
+@router.prefix("toggle_content:")
+async def toggle_content(query, user_id: str, settings: dict, content_type: str):
+    settings["supported_content"][content_type] = not settings["supported_content"][content_type]
+    save_settings(user_id)
+    await content_types_settings_menu(query, user_id)
+
+# ----- View Logs -----
+
+@router.exact("view_logs")
+async def view_logs(query, user_id: str, settings: dict, arg):
+    store.poll_changes()  # Pick up the scheduler's latest last_repost_time
+    log_text = "Logs:\n"
+    log_text += "Last repost: " + str(settings.get("last_repost_time", "Never"))
+    keys = [login_key(user_id)] + [source_key(source) for source in settings["source_accounts"]]
+    for key, failures, open_until, suppressed, last_error in breakers.status(keys):
+        kind, name = key.split(":", 1)
+        label = "Instagram login" if kind == "login" else f"Source {name}"
+        retry_at = datetime.fromtimestamp(open_until).strftime("%Y-%m-%d %H:%M:%S")
+        log_text += (
+            f"\n\n{label}: {failures} failure(s), "
+            f"retrying after {retry_at} ({suppressed} retries skipped)\n"
+            f"Last error: {last_error}"
+        )
+    await query.edit_message_text(log_text)
 
-    # ----- View Logs -----
-    if data == "view_logs":
-        log_text = "Logs:\n"
-        log_text += "Last repost: " + str(settings.get("last_repost_time", "Never"))
-        await query.edit_message_text(log_text)
-        return
+# ----- Set Interval Menu -----
 
-    # ----- Set Interval Menu -----
-    if data == "set_interval_menu":
-        await set_interval_menu(query)
-        return
+@router.exact("set_interval_menu")
+async def show_set_interval_menu(query, user_id: str, settings: dict, arg):
+    await set_interval_menu(query)
 
 async def manage_sources_menu(query, user_id: str):
     """Display the menu to manage Instagram source accounts."""
     settings = get_user_settings(user_id)
-    keyboard = []
-    for source in settings["source_accounts"]:
-        keyboard.append([InlineKeyboardButton(f"Remove {source}", callback_data=f"remove_source:{source}")])
-    keyboard.append([InlineKeyboardButton("Add New Source Account", callback_data="add_source")])
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = keyboards.get("sources", tuple(settings["source_accounts"]), build_sources_keyboard)
     await query.edit_message_text("Manage your Instagram source accounts:", reply_markup=reply_markup)
 
 async def reposting_settings_menu(query, user_id: str):
     """Display the reposting settings menu with toggle options."""
     settings = get_user_settings(user_id)
-    auto_status = "ON" if settings["auto_repost"] else "OFF"
-    caption_status = "Original" if settings["use_original_caption"] else "Custom"
-    interval = settings["repost_interval"]
-    keyboard = [
-        [InlineKeyboardButton(f"Auto-Repost: {auto_status}", callback_data="toggle_auto_repost")],
-        [InlineKeyboardButton(f"Caption: {caption_status}", callback_data="toggle_caption")],
-        [InlineKeyboardButton(f"Repost Interval: {interval} hour(s)", callback_data="set_interval_menu")],
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    state = (bool(settings["auto_repost"]), bool(settings["use_original_caption"]), settings["repost_interval"])
+    reply_markup = keyboards.get("reposting", state, build_reposting_keyboard)
     await query.edit_message_text("Adjust your reposting settings:", reply_markup=reply_markup)
 
 async def set_interval_menu(query):
     """Display the menu for selecting repost interval."""
-    keyboard = [
-        [InlineKeyboardButton("1 hour", callback_data="set_interval:1"),
-         InlineKeyboardButton("2 hours", callback_data="set_interval:2")],
-        [InlineKeyboardButton("3 hours", callback_data="set_interval:3"),
-         InlineKeyboardButton("4 hours", callback_data="set_interval:4")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text("Select your desired repost interval:", reply_markup=reply_markup)
+    await query.edit_message_text("Select your desired repost interval:", reply_markup=INTERVAL_KEYBOARD)
 
 async def content_types_settings_menu(query, user_id: str):
     """Display the menu for toggling supported content types."""
     settings = get_user_settings(user_id)
-    keyboard = [
-        [InlineKeyboardButton(
-            f"Reels: {'ON' if settings['supported_content']['reels'] else 'OFF'}",
-            callback_data="toggle_content:reels")],
-        [InlineKeyboardButton(
-            f"Photos: {'ON' if settings['supported_content']['photos'] else 'OFF'}",
-            callback_data="toggle_content:photos")],
-        [InlineKeyboardButton(
-            f"Carousels: {'ON' if settings['supported_content']['carousels'] else 'OFF'}",
-            callback_data="toggle_content:carousels")]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    content = settings["supported_content"]
+    state = (bool(content["reels"]), bool(content["photos"]), bool(content["carousels"]))
+    reply_markup = keyboards.get("content_types", state, build_content_types_keyboard)
     await query.edit_message_text("Select which content types to repost:", reply_markup=reply_markup)
 
+def build_application(token: str) -> Application:
+    """Create the Telegram Application with the bot's handlers registered."""
+    builder = Application.builder().token(token)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    app = builder.build()
+
+    app.add_handler(CommandHandler("start", start))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
+    app.add_handler(CallbackQueryHandler(button_handler))
+    return app
+
 def main():
     """Initialize and run the Telegram bot."""
     TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
@@ -299,13 +371,23 @@ def main():
         logger.error("Telegram token not set in environment variables.")
         return
 
-    app = Application.builder().token(TELEGRAM_TOKEN).build()
-
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
-    app.add_handler(CallbackQueryHandler(button_handler))
-
-    app.run_polling()
+    app = build_application(TELEGRAM_TOKEN)
+    webhook_url = WEBHOOK_URL
+    if webhook_url and importlib.util.find_spec("tornado") is None:
+        # run_webhook() needs the webhooks extra; server.py serves webhooks itself.
+        logger.error("TELEGRAM_WEBHOOK_URL is set but python-telegram-bot[webhooks] is not "
+                     "installed; falling back to polling")
+        webhook_url = None
+    if webhook_url:
+        app.run_webhook(
+            listen=LISTEN_ADDR,
+            port=int(os.environ.get("PORT", 8443)),
+            url_path=WEBHOOK_PATH.lstrip("/"),
+            secret_token=WEBHOOK_SECRET,
+            webhook_url=webhook_url.rstrip("/") + WEBHOOK_PATH,
+        )
+    else:
+        app.run_polling()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,226 @@
+"""
+media_cache.py - Shared On-Disk Media Cache
+--------------------------------------------
+This module downloads each source media item once and shares the files
+between every user who reposts it:
+- Entries are keyed by media pk; files are stored under their SHA-256
+  content hash, so identical content is kept once.
+- Entries in use by an upload are reference counted and never evicted.
+- Unused entries are evicted least recently used first once the cache
+  exceeds its disk quota, and files left by an earlier run are deleted on
+  start, so downloads no longer pile up in the working directory.
+The cache marks its directory with a MARKER file and only ever deletes
+files it could have written there. It refuses to use a non-empty
+directory without the marker, so pointing MEDIA_CACHE_DIR at "." or a
+shared volume cannot wipe unrelated files.
+"""
+
+import os
+import re
+import shutil
+import hashlib
+import logging
+import tempfile
+import threading
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+MEDIA_CACHE_DIR = os.environ.get("MEDIA_CACHE_DIR", "media_cache")
+MEDIA_CACHE_QUOTA_MB = int(os.environ.get("MEDIA_CACHE_QUOTA_MB", "1024"))
+# File marking a directory as owned by the cache.
+MARKER = ".media_cache"
+# Names of cached files (content hash plus suffix) and download staging directories.
+CACHE_FILE = re.compile(r"[0-9a-f]{64}(\.\w+)?")
+STAGING_PREFIX = "download-"
+
+
+def file_hash(path: Path) -> str:
+    """Return the SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_cache_file(path: Path) -> bool:
+    """Return True if the cache could have created `path` in its directory."""
+    if path.is_dir():
+        return path.name.startswith(STAGING_PREFIX)
+    return CACHE_FILE.fullmatch(path.name) is not None
+
+
+class CacheEntry:
+    """Files downloaded for one media pk."""
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.hashes = []
+        self.paths = []
+        self.refs = 0
+        self.error = None
+
+
+class MediaCache:
+    """Content-addressed, quota-bounded cache of downloaded media files."""
+
+    def __init__(self, directory: str = MEDIA_CACHE_DIR, quota_mb: int = MEDIA_CACHE_QUOTA_MB):
+        self.directory = Path(directory)
+        self.quota = quota_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # media pk -> CacheEntry, least recently used first
+        self.files = {}               # content hash -> [path, size, number of entries using it]
+        self.size = 0
+        self._clear()
+
+    def _clear(self):
+        """
+        Take ownership of the cache directory and delete files left in it by
+        an earlier run. A directory without the marker is only adopted if
+        everything in it looks like cache files; otherwise RuntimeError is
+        raised and nothing is deleted.
+        """
+        self.directory.mkdir(parents=True, exist_ok=True)
+        marker = self.directory / MARKER
+        leftovers = [path for path in self.directory.iterdir() if path.name != MARKER]
+        if not marker.exists():
+            foreign = [path.name for path in leftovers if not is_cache_file(path)]
+            if foreign:
+                raise RuntimeError(
+                    "Refusing to use %s as the media cache: it holds files the cache did not "
+                    "create (%s); set MEDIA_CACHE_DIR to a dedicated directory"
+                    % (self.directory.resolve(), ", ".join(sorted(foreign)[:5]))
+                )
+            marker.touch()
+        for path in leftovers:
+            if not is_cache_file(path):
+                continue
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink()
+
+    @contextmanager
+    def acquire(self, media_pk, download):
+        """
+        Yield the local file paths for a media item, downloading it first if
+        needed; the files are pinned until the block exits.
+        """
+        paths = self.pin(media_pk, download)
+        try:
+            yield paths
+        finally:
+            self.release(media_pk)
+
+    def pin(self, media_pk, download) -> list:
+        """
+        Return the local file paths for a media item, downloading it first if
+        needed, and pin them until release() is called with the same pk.
+        `download(folder)` must save the media into `folder` and return a
+        path or a list of paths. Concurrent callers for the same pk share
+        one download.
+        """
+        media_pk = str(media_pk)
+        with self.lock:
+            entry = self.entries.get(media_pk)
+            if entry is None or entry.error is not None:
+                entry = CacheEntry()
+                self.entries[media_pk] = entry
+                owner = True
+            else:
+                self.entries.move_to_end(media_pk)
+                owner = False
+            entry.refs += 1
+        try:
+            if owner:
+                self._fill(media_pk, entry, download)
+            else:
+                entry.ready.wait()
+                if entry.error is not None:
+                    raise entry.error
+        except Exception:
+            self._unref(media_pk, entry)
+            raise
+        return list(entry.paths)
+
+    def release(self, media_pk):
+        """Unpin a media item pinned with pin()."""
+        media_pk = str(media_pk)
+        with self.lock:
+            entry = self.entries.get(media_pk)
+        if entry is not None:
+            self._unref(media_pk, entry)
+
+    def _unref(self, media_pk: str, entry: CacheEntry):
+        """Drop one reference to an entry and evict if over quota."""
+        with self.lock:
+            entry.refs -= 1
+            if entry.error is not None and entry.refs == 0 and self.entries.get(media_pk) is entry:
+                del self.entries[media_pk]
+            self._evict()
+
+    def _fill(self, media_pk: str, entry: CacheEntry, download):
+        """Download a media item into the cache and register its files."""
+        staging = Path(tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=self.directory))
+        try:
+            result = download(staging)
+            paths = result if isinstance(result, (list, tuple)) else [result]
+            for path in paths:
+                path = Path(path)
+                content_hash = file_hash(path)
+                with self.lock:
+                    known = self.files.get(content_hash)
+                    if known is None:
+                        target = self.directory / (content_hash + path.suffix)
+                        os.replace(path, target)
+                        known = [target, target.stat().st_size, 0]
+                        self.files[content_hash] = known
+                        self.size += known[1]
+                    known[2] += 1
+                entry.hashes.append(content_hash)
+                entry.paths.append(known[0])
+        except Exception as e:
+            entry.error = e
+            with self.lock:
+                self._drop_files(entry)
+            raise
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+            entry.ready.set()
+
+    def _drop_files(self, entry: CacheEntry):
+        """Drop an entry's claim on its files, deleting files no entry uses; the caller holds the lock."""
+        for content_hash in entry.hashes:
+            known = self.files[content_hash]
+            known[2] -= 1
+            if known[2] == 0:
+                del self.files[content_hash]
+                self.size -= known[1]
+                self._delete(known[0])
+        entry.hashes = []
+        entry.paths = []
+
+    def _delete(self, path: Path):
+        """Remove a cached file and side files created next to it (e.g. video thumbnails)."""
+        for stale in [path] + list(path.parent.glob(path.name + ".*")):
+            try:
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """Evict unpinned entries, least recently used first, until under quota; the caller holds the lock."""
+        if self.size <= self.quota:
+            return
+        for media_pk in list(self.entries):
+            if self.size <= self.quota:
+                break
+            entry = self.entries[media_pk]
+            if entry.refs or not entry.ready.is_set():
+                continue
+            del self.entries[media_pk]
+            self._drop_files(entry)
+            logger.debug("Evicted media %s from cache", media_pk)
@@ -0,0 +1,138 @@
+"""
+pacing.py - Per-Account Action Pacing
+--------------------------------------
+This module spaces out actions on the same Instagram account without
+blocking work for other accounts:
+- Pacer plans time slots per account, each at least PACING_DELAY seconds
+  after the previous one plus random jitter, and enforces the gap when the
+  action actually runs: begin() admits one action per account at a time,
+  and only PACING_DELAY (plus jitter) after the previous one finished.
+- DelayQueue is a bounded queue that releases each item only once its slot
+  has arrived, always the earliest ready item first. An item whose account
+  is not ready yet is requeued with a later ready time instead of holding
+  a worker, so workers are never parked on behalf of one account.
+"""
+
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+
+# Minimum seconds between two actions on the same account, plus up to
+# PACING_JITTER random seconds so the spacing does not look mechanical.
+PACING_DELAY = float(os.environ.get("PACING_DELAY", "5"))
+PACING_JITTER = float(os.environ.get("PACING_JITTER", "5"))
+# Seconds before retrying an action whose account is still busy with another.
+BUSY_RETRY = 1.0
+
+
+class Pacer:
+    """Plans and enforces evenly spaced, jittered actions per account."""
+
+    def __init__(self, delay: float = PACING_DELAY, jitter: float = PACING_JITTER):
+        self.delay = delay
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.last_slot = {}
+        self.busy = set()      # Accounts with an action in progress
+        self.next_start = {}   # Account -> earliest start of its next action
+
+    def reserve(self, account: str) -> float:
+        """
+        Plan the account's next action and return the monotonic time at which
+        it is expected to run. The slot is a plan; begin() has the final say.
+        """
+        now = time.monotonic()
+        with self.lock:
+            previous = self.last_slot.get(account)
+            slot = now if previous is None else max(
+                now, previous + self.delay + random.uniform(0, self.jitter)
+            )
+            self.last_slot[account] = slot
+            # Forget accounts whose last slot is long past.
+            if len(self.last_slot) > 1024:
+                cutoff = now - self.delay - self.jitter
+                for stale in [key for key, value in self.last_slot.items() if value < cutoff]:
+                    del self.last_slot[stale]
+                    self.next_start.pop(stale, None)
+        return slot
+
+    def begin(self, account: str) -> float:
+        """
+        Start an action on the account if it may run now and return 0; the
+        caller must call finish() afterwards. Otherwise return the seconds
+        to wait before trying again: the account is busy with another action,
+        or its previous action finished less than the pacing gap ago.
+        """
+        with self.lock:
+            if account in self.busy:
+                return max(BUSY_RETRY, self.delay)
+            wait = self.next_start.get(account, 0.0) - time.monotonic()
+            if wait > 0:
+                return wait
+            self.busy.add(account)
+            return 0.0
+
+    def finish(self, account: str):
+        """End an action started with begin() and space the next one from now."""
+        now = time.monotonic()
+        with self.lock:
+            self.busy.discard(account)
+            next_start = now + self.delay + random.uniform(0, self.jitter)
+            self.next_start[account] = next_start
+            # Plan later actions from when this one actually ended.
+            self.last_slot[account] = max(self.last_slot.get(account, next_start), next_start)
+
+
+class DelayQueue:
+    """
+    Bounded queue ordered by ready time. Items are put with put(item); the
+    ready time comes from `ready_at(item)`. get() returns the earliest item
+    once its ready time has passed. Provides the subset of queue.Queue used
+    by pipeline stages.
+    """
+
+    def __init__(self, maxsize: int, ready_at):
+        self.maxsize = maxsize
+        self.ready_at = ready_at
+        self.heap = []
+        self.counter = itertools.count()  # Keeps equal ready times in FIFO order
+        self.cond = threading.Condition()
+
+    def put(self, item):
+        """Queue an item, blocking while the queue is full."""
+        ready = self.ready_at(item)
+        with self.cond:
+            while self.maxsize > 0 and len(self.heap) >= self.maxsize:
+                self.cond.wait()
+            heapq.heappush(self.heap, (ready, next(self.counter), item))
+            self.cond.notify_all()
+
+    def requeue(self, item, ready: float):
+        """
+        Put back an item taken from this queue, to be released at `ready`.
+        Never blocks: the item already had its place, and a worker requeueing
+        into a full queue must not wait on itself.
+        """
+        with self.cond:
+            heapq.heappush(self.heap, (ready, next(self.counter), item))
+            self.cond.notify_all()
+
+    def get(self):
+        """Remove and return the earliest item, waiting until it is ready."""
+        with self.cond:
+            while True:
+                if self.heap:
+                    wait = self.heap[0][0] - time.monotonic()
+                    if wait <= 0:
+                        item = heapq.heappop(self.heap)[2]
+                        self.cond.notify_all()
+                        return item
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+
+    def task_done(self):
+        """Present for queue.Queue compatibility; nothing to track."""
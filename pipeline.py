@@ -0,0 +1,85 @@
+"""
+pipeline.py - Staged Worker Pipeline
+-------------------------------------
+This module provides a small thread-based pipeline: each stage has its own
+worker threads and a bounded inbound queue, and hands its outputs to the
+next stage. A full queue blocks the stage feeding it (backpressure), so a
+slow stage throttles the ones before it instead of letting work pile up in
+memory, while independent items overlap across stages.
+"""
+
+import queue
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Stage:
+    """
+    A group of worker threads running `handler` on items from a bounded queue.
+    The handler returns an iterable of outputs (a generator works well) that
+    are put on the next stage's queue as they are produced. A custom inbound
+    queue (anything with put/get/task_done) may replace the default FIFO.
+    """
+
+    def __init__(self, name: str, handler, workers: int, queue_size: int = 0, inbound=None):
+        self.name = name
+        self.handler = handler
+        self.workers = workers
+        self.queue = inbound if inbound is not None else queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.threads = []
+
+    def put(self, item):
+        """Queue an item, blocking while the stage is full."""
+        self.queue.put(item)
+
+    def start(self):
+        """Start the stage's worker threads."""
+        for index in range(self.workers):
+            thread = threading.Thread(
+                target=self._work, name="%s-%d" % (self.name, index), daemon=True
+            )
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        """Worker loop: run the handler and forward its outputs downstream."""
+        while True:
+            item = self.queue.get()
+            try:
+                for output in self.handler(item) or ():
+                    if self.next_stage is None:
+                        raise RuntimeError("Stage %s has no next stage" % self.name)
+                    self.next_stage.put(output)
+            except Exception as e:
+                # Handlers are expected to deal with their own errors.
+                logger.exception("Unhandled error in %s stage: %s", self.name, e)
+            finally:
+                self.queue.task_done()
+
+
+class Pipeline:
+    """Stages connected in order; items submitted enter the first stage."""
+
+    def __init__(self, *stages: Stage):
+        self.stages = stages
+        for upstream, downstream in zip(stages, stages[1:]):
+            upstream.next_stage = downstream
+        self.started = False
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start every stage's workers; calling it again is a no-op."""
+        with self.lock:
+            if self.started:
+                return
+            for stage in self.stages:
+                stage.start()
+            self.started = True
+
+    def submit(self, item):
+        """Feed an item into the first stage, starting the pipeline if needed."""
+        self.start()
+        self.stages[0].put(item)
@@ -0,0 +1,116 @@
+"""
+ratelimit.py - Instagram API Rate Limiting
+-------------------------------------------
+This module keeps count of the calls made to Instagram with token buckets
+at several scopes, so the bot stays under Instagram's throttling instead of
+discovering it through errors:
+- "account": calls made by one destination account's client.
+- "source": fetches of one source account, across all users.
+- "proxy": calls going out through one proxy.
+- "global": every call the process makes.
+A call takes a token from each bucket that applies to it. Callers can ask
+how long until a call would be allowed (to plan work around the limits),
+or take the tokens only if the call is allowed now and otherwise learn how
+long to wait; nothing here sleeps. Limits are configured as
+"<calls>/<seconds>".
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LIMITS = {
+    "account": os.environ.get("RATE_LIMIT_ACCOUNT", "200/3600"),
+    "source": os.environ.get("RATE_LIMIT_SOURCE", "60/3600"),
+    "proxy": os.environ.get("RATE_LIMIT_PROXY", "400/3600"),
+    "global": os.environ.get("RATE_LIMIT_GLOBAL", "2000/3600"),
+}
+
+
+def parse_limit(limit: str):
+    """Parse "<calls>/<seconds>" into (tokens per second, bucket capacity)."""
+    calls, seconds = limit.split("/", 1)
+    calls, seconds = float(calls), float(seconds)
+    return calls / seconds, calls
+
+
+class RateLimited(Exception):
+    """Raised instead of waiting when a call is not allowed yet; `wait` is in seconds."""
+
+    def __init__(self, keys: list, wait: float):
+        super().__init__("Rate limited on %s for %.1fs" % (keys, wait))
+        self.keys = keys
+        self.wait = wait
+
+
+class TokenBucket:
+    """Classic token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Seconds until one token is available."""
+        self._refill(now)
+        wait = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(wait, self.blocked_until - now)
+
+    def consume(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class RateLimiter:
+    """Token buckets keyed by (scope, key), created on first use."""
+
+    def __init__(self, limits: dict = None):
+        self.limits = {
+            scope: parse_limit(limit) for scope, limit in (limits or DEFAULT_LIMITS).items()
+        }
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def _bucket(self, scope: str, key: str) -> TokenBucket:
+        bucket = self.buckets.get((scope, key))
+        if bucket is None:
+            bucket = TokenBucket(*self.limits[scope])
+            self.buckets[(scope, key)] = bucket
+        return bucket
+
+    def next_available(self, keys: list) -> float:
+        """Return how many seconds until a call counted against `keys` is allowed."""
+        now = time.monotonic()
+        with self.lock:
+            return max((self._bucket(scope, key).delay(now) for scope, key in keys), default=0.0)
+
+    def try_acquire(self, keys: list) -> float:
+        """
+        Take a token from every bucket if all have one and return 0;
+        otherwise take nothing and return the seconds to wait.
+        """
+        now = time.monotonic()
+        with self.lock:
+            buckets = [self._bucket(scope, key) for scope, key in keys]
+            wait = max((bucket.delay(now) for bucket in buckets), default=0.0)
+            if wait <= 0:
+                for bucket in buckets:
+                    bucket.consume(now)
+            return wait
+
+    def throttle(self, scope: str, key: str, seconds: float):
+        """Block a bucket for `seconds`, e.g. after Instagram asked us to slow down."""
+        with self.lock:
+            bucket = self._bucket(scope, key)
+            bucket.blocked_until = max(bucket.blocked_until, time.monotonic() + seconds)
+        logger.warning("Instagram throttled %s %s; pausing it for %ds", scope, key, seconds)
@@ -2,95 +2,836 @@
 repost.py - Instagram Reposting Functions
 -------------------------------------------
 This module provides functions to:
-- Log in to Instagram with each user’s destination account credentials.
+- Log in to Instagram with each user’s destination account credentials,
+  reusing live pooled clients and cached sessions where possible.
 - Fetch recent media (Reels, Photos, Carousels) from source accounts.
 - Repost supported media to the destination account.
-- Apply simple anti-detection delays.
+- Pace actions per destination account with randomized delays, without
+  holding up other accounts.
+- Count every Instagram API call against per-account, per-source, per-proxy
+  and global rate limits; work that would exceed them is put back in its
+  stage's queue until they allow it, so no worker sleeps on a limit.
+- Resolve source usernames to user ids in the background, ahead of polling.
+- Back off from logins and sources that keep failing, using circuit breakers.
+- Run reposts through a fetch -> download -> upload pipeline, so downloads
+  for one item overlap uploads of another and each stage is sized separately.
+- Repost carousels as albums, downloading their slides in parallel.
+- Track every repost as a durable job, so work interrupted by a restart is
+  resumed by the next run instead of being lost.
+- Record every upload in a ledger and, after an upload that may or may not
+  have gone through, check the destination's latest posts before retrying.
 """
 
 import os
 import time
-import json
 import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
 from datetime import datetime
 from instagrapi import Client
+from instagrapi.exceptions import (
+    LoginRequired,
+    PleaseWaitFewMinutes,
+    RateLimitError,
+    ClientThrottledError,
+    UserNotFound,
+    PrivateAccount,
+    ClientNotFoundError,
+    ClientConnectionError,
+    ClientRequestTimeout,
+)
+from requests.exceptions import RequestException
+from instagrapi.types import Media
+from storage import get_store
+from seen_media import SeenMediaIndex
+from sessions import SessionCache
+from client_pool import ClientPool, client_lock
+from source_feed import SourceFeed, ALL_MEDIA
+from media_cache import MediaCache
+from pipeline import Pipeline, Stage
+from pacing import Pacer, DelayQueue
+from ratelimit import RateLimiter, RateLimited
+from breakers import CircuitBreakers, login_key, source_key
+from job_queue import JobQueue, DOWNLOADING, UPLOADING, DONE, FAILED
+from upload_ledger import UploadLedger
+from source_ids import (
+    SourceIdCache,
+    SourceUnavailable,
+    RESOLVED,
+    NOT_FOUND,
+    PRIVATE,
+    NEGATIVE_STATUSES,
+)
 
 # Logger setup
 logger = logging.getLogger(__name__)
 
-SETTINGS_FILE = "user_settings.json"
-if os.path.exists(SETTINGS_FILE):
-    with open(SETTINGS_FILE, "r") as file:
-        user_settings = json.load(file)
-else:
-    user_settings = {}
+store = get_store()
+user_settings = store.users
+seen_media = SeenMediaIndex()
+sessions = SessionCache()
+client_pool = ClientPool()
+source_feed = SourceFeed()
+media_cache = MediaCache()
+pacer = Pacer()
+rate_limiter = RateLimiter()
+source_ids = SourceIdCache()
+breakers = CircuitBreakers()
+job_queue = JobQueue()
+upload_ledger = UploadLedger()
+# Username lookups run here, off the fetch path.
+resolver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="resolve")
+# Carousel slides are downloaded here, all slides of an album at once.
+ALBUM_WORKERS = int(os.environ.get("ALBUM_WORKERS", "10"))
+album_downloader = ThreadPoolExecutor(max_workers=ALBUM_WORKERS, thread_name_prefix="album")
 
-def save_settings():
-    """Save updated user settings to file."""
-    with open(SETTINGS_FILE, "w") as file:
-        json.dump(user_settings, file, indent=4)
+# Errors Instagram uses to say "slow down", and how long to pause the
+# account (and proxy) that received one.
+THROTTLE_ERRORS = (PleaseWaitFewMinutes, RateLimitError, ClientThrottledError)
+THROTTLE_BACKOFF = 10 * 60
+# Errors that say nothing about the account or source involved (throttling,
+# network trouble); they never count against a circuit breaker.
+TRANSIENT_ERRORS = THROTTLE_ERRORS + (
+    ClientConnectionError,
+    ClientRequestTimeout,
+    RequestException,
+    ConnectionError,
+    TimeoutError,
+)
+# Errors that are the source account's own fault (missing, private); only
+# these open the source's breaker, which every user of the source shares.
+SOURCE_ERRORS = (SourceUnavailable, UserNotFound, PrivateAccount, ClientNotFoundError)
+
+# Seconds a cached session is trusted before it is checked with an API call again.
+SESSION_CHECK_INTERVAL = 15 * 60
+
+# Worker threads per pipeline stage, and the size of the queue in front of
+# the download and upload stages.
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "4"))
+DOWNLOAD_WORKERS = int(os.environ.get("DOWNLOAD_WORKERS", "4"))
+UPLOAD_WORKERS = int(os.environ.get("UPLOAD_WORKERS", "4"))
+STAGE_QUEUE_SIZE = int(os.environ.get("STAGE_QUEUE_SIZE", "16"))
+# Seconds before its upload slot that an item may start downloading.
+DOWNLOAD_LEAD = 30.0
+
+# Media requested per GraphQL page. Instagram serves up to 50 items per page;
+# asking for a full page keeps end_cursor aligned with what was returned.
+PAGE_SIZE = 50
+# Items reposted from a source the first time it is polled (no watermark yet).
+INITIAL_FETCH = 5
+# Upper bound on pages walked back to the watermark in one poll.
+MAX_PAGES = 10
+# Latest destination posts checked for an upload whose outcome is unknown,
+# and the clock skew allowed between this host and Instagram.
+RECONCILE_DEPTH = 5
+RECONCILE_SLACK = 60
+
+def sync_settings():
+    """
+    Pick up settings changed by the bot process since the last call.
+    Only the users whose rows changed are re-read.
+    """
+    return store.poll_changes()
+
+def account_keys(user_id: str, settings: dict) -> list:
+    """Rate-limit buckets charged for a call made with a user's client."""
+    keys = [("global", ""), ("account", user_id)]
+    if settings.get("proxy"):
+        keys.append(("proxy", settings["proxy"]))
+    return keys
+
+def call_instagram(keys: list, func, *args, **kwargs):
+    """
+    Make one Instagram API call if the rate limits for `keys` allow it now,
+    and raise RateLimited with the time to wait otherwise. `func` is a
+    bound method of the client making the call; calls on one client are
+    serialized by its client_lock().
+    A throttling error pauses the account and proxy buckets involved.
+    """
+    wait = rate_limiter.try_acquire(keys)
+    if wait > 0:
+        raise RateLimited(keys, wait)
+    try:
+        with client_lock(func.__self__):
+            return func(*args, **kwargs)
+    except THROTTLE_ERRORS:
+        for scope, key in keys:
+            if scope in ("account", "proxy"):
+                rate_limiter.throttle(scope, key, THROTTLE_BACKOFF)
+        raise
+
+def next_allowed(user_id: str) -> float:
+    """
+    Seconds until a run for the user could make progress: its account may
+    make calls again and at least one of its sources may be fetched.
+    """
+    settings = user_settings.get(user_id, {})
+    wait = rate_limiter.next_available(account_keys(user_id, settings))
+    sources = settings.get("source_accounts") or []
+    if sources:
+        wait = max(wait, min(rate_limiter.next_available([("source", source)]) for source in sources))
+    return wait
 
 def login_instagram(user_id: str):
     """
     Log in to Instagram using the user's destination account credentials.
-    Returns an instagrapi Client instance on success.
+    A live client from the pool is returned directly. Otherwise a cached
+    session is reused when one exists; it is only re-checked with an API
+    call every SESSION_CHECK_INTERVAL seconds, and a full login happens only
+    if it turns out to be invalid.
+    Returns an instagrapi Client instance on success and raises the error
+    that made the login fail otherwise, so callers can tell a rejected
+    login from throttling or network trouble.
     """
     settings = user_settings.get(user_id, {})
+    username = settings.get("instagram_username")
+    password = settings.get("instagram_password")
+    fingerprint = (username, password, settings.get("proxy"))
+    keys = account_keys(user_id, settings)
+    client = client_pool.get(user_id, fingerprint)
+    if client:
+        return client
+
     client = Client()
     try:
         if settings.get("proxy"):
             client.set_proxy(settings["proxy"])
-        client.login(settings["instagram_username"], settings["instagram_password"])
+
+        cached = sessions.load(user_id, username)
+        if cached:
+            session, validated_at = cached
+            client.set_settings(session)
+            client.login(username, password)  # Reuses the session's cookies
+            if time.time() - validated_at < SESSION_CHECK_INTERVAL:
+                client_pool.put(user_id, fingerprint, client)
+                return client
+            try:
+                call_instagram(keys, client.get_timeline_feed)
+                sessions.save(user_id, username, client.get_settings())
+                logger.info("Reused Instagram session for user %s", user_id)
+                client_pool.put(user_id, fingerprint, client)
+                return client
+            except LoginRequired:
+                logger.info("Cached session expired for user %s, logging in again", user_id)
+                old_session = client.get_settings()
+                client.set_settings({})
+                client.set_uuids(old_session["uuids"])  # Keep the same device identity
+
+        call_instagram(keys, client.login, username, password)
+        sessions.save(user_id, username, client.get_settings())
         logger.info("Instagram login successful for user %s", user_id)
+        client_pool.put(user_id, fingerprint, client)
+    except RateLimited:
+        raise
     except Exception as e:
         logger.error("Instagram login failed for user %s: %s", user_id, e)
-        return None
+        raise
     return client
 
-def check_and_repost():
+def lookup_source(client, source: str, keys: list):
+    """Look a source username up on Instagram and cache the result."""
+    try:
+        user = call_instagram(keys, client.user_info_by_username, source)
+    except UserNotFound:
+        source_ids.store(source, None, NOT_FOUND)
+        logger.warning("Source account %s does not exist", source)
+        return None, NOT_FOUND
+    status = PRIVATE if user.is_private else RESOLVED
+    source_ids.store(source, user.pk, status)
+    return str(user.pk), status
+
+def resolve_sources(user_id: str):
+    """Resolve a user's sources that are new or due for a refresh."""
+    settings = user_settings.get(user_id)
+    if not settings:
+        return
+    stale = []
+    for source in list(settings.get("source_accounts", [])):
+        entry = source_ids.get(source)
+        if entry is None or not source_ids.is_fresh(entry):
+            stale.append(source)
+    if not stale:
+        return
+    login = login_key(user_id)
+    if not breakers.allow(login):
+        return  # Login is backing off; the sources are resolved once it succeeds
+    try:
+        client = login_instagram(user_id)
+    except TRANSIENT_ERRORS + (RateLimited,):
+        return  # Logged by login_instagram; retried on the next settings change or poll
+    except Exception as e:
+        breakers.record_failure(login, e)
+        return
+    finally:
+        breakers.release_probe(login)
+    breakers.record_success(login)
+    keys = account_keys(user_id, settings)
+    for source in stale:
+        try:
+            lookup_source(client, source, keys)
+        except Exception as e:
+            logger.error("Could not resolve source %s for user %s: %s", source, user_id, e)
+
+def submit_resolve(user_ids):
+    """Queue background resolution of sources for users whose settings changed."""
+    for user_id in user_ids:
+        settings = user_settings.get(user_id)
+        if settings and settings.get("instagram_username") and settings.get("source_accounts"):
+            resolver.submit(resolve_sources, user_id)
+
+def source_user_pk(client, source: str, keys: list) -> str:
+    """
+    Return the numeric user id for a source username from the cache.
+    An expired id is still used while a refresh runs in the background; a
+    lookup happens inline only for a source that was never resolved.
+    Raises SourceUnavailable for sources cached as missing or private.
+    """
+    entry = source_ids.get(source)
+    if entry is not None:
+        user_pk, status, _ = entry
+        fresh = source_ids.is_fresh(entry)
+        if status == RESOLVED:
+            if not fresh:
+                resolver.submit(lookup_source, client, source, keys)
+            return user_pk
+        if status in NEGATIVE_STATUSES and fresh:
+            raise SourceUnavailable("Source %s is %s" % (source, status.replace("_", " ")))
+    user_pk, status = lookup_source(client, source, keys)
+    if status != RESOLVED:
+        raise SourceUnavailable("Source %s is %s" % (source, status.replace("_", " ")))
+    return user_pk
+
+def fetch_new_media(client, source: str, watermark, keys: list):
+    """
+    Return the source's media newer than the watermark, oldest first.
+    Users following the same source share one upstream fetch through
+    source_feed; `client` (and its rate-limit `keys`) is only used if this
+    call has to fetch.
+    """
+    return source_feed.get(
+        source, watermark, INITIAL_FETCH,
+        lambda floor: fetch_source_media(client, source, floor, keys),
+    )
+
+def fetch_source_media(client, source: str, watermark, keys: list):
+    """
+    Fetch the source's media newer than the watermark from Instagram.
+    Pages are requested only until the oldest item on one is at or below
+    the watermark, so a quiet source costs a single request and a busy one
+    is followed back as far as needed. Pinned posts, which head the first
+    page whatever their age, are filtered like any other item but never
+    end the walk. Without a watermark only the latest INITIAL_FETCH items
+    are fetched.
+    Returns (items oldest first, covered_since): every item taken after
+    covered_since is included.
+    """
+    user_pk = source_user_pk(client, source, keys)
+    keys = keys + [("source", source)]
+    if watermark is None:
+        media_items = call_instagram(keys, client.user_medias_gql, user_pk, INITIAL_FETCH)
+        if len(media_items) < INITIAL_FETCH:
+            covered_since = ALL_MEDIA  # The source has no older posts
+        else:
+            # Pinned posts head the response whatever their age; the rest is
+            # newest first, so the last item bounds what was fetched.
+            covered_since = media_items[-1].taken_at.timestamp()
+        return sorted(media_items, key=lambda media: media.taken_at), covered_since
+
+    new_items = {}
+    end_cursor = None
+    for _ in range(MAX_PAGES):
+        media_items, end_cursor = call_instagram(
+            keys, client.user_medias_paginated_gql, user_pk, PAGE_SIZE, end_cursor=end_cursor
+        )
+        for media in media_items:
+            if media.taken_at.timestamp() > watermark:
+                new_items.setdefault(str(media.pk), media)
+        # Pages are newest first apart from pinned posts at the top of the
+        # first one, so only the last item says whether older pages matter.
+        if not end_cursor or not media_items or media_items[-1].taken_at.timestamp() <= watermark:
+            break
+    else:
+        logger.warning("Stopped after %d pages of new media from %s", MAX_PAGES, source)
+        covered_since = media_items[-1].taken_at.timestamp() if media_items else watermark
+        return sorted(new_items.values(), key=lambda media: media.taken_at), covered_since
+    return sorted(new_items.values(), key=lambda media: media.taken_at), watermark
+
+class RepostRun:
+    """
+    One user's repost run as it moves through the pipeline.
+    `pending` counts the fetch step plus every media job still in flight;
+    the run's Future resolves when it drops to zero. A fetch step stopped
+    by the rate limits is requeued at `ready_at` (time.monotonic()) and
+    resumes with source `next_source`.
+    """
+
+    def __init__(self, user_id: str, settings: dict):
+        self.user_id = user_id
+        self.settings = settings
+        self.client = None
+        self.keys = account_keys(user_id, settings)
+        self.sources = list(settings.get("source_accounts", []))
+        self.next_source = 0
+        self.started = False
+        self.ready_at = 0.0
+        self.session_valid = True
+        self.future = Future()
+        self.pending = 1
+        self.lock = threading.Lock()
+
+    def add(self):
+        """Account for one more media job."""
+        with self.lock:
+            self.pending += 1
+
+    def done(self):
+        """Mark the fetch step or one media job as finished."""
+        with self.lock:
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            try:
+                finish_run(self)
+            finally:
+                self.future.set_result(None)
+
+class SourceBatch:
+    """
+    New media from one source within a run, oldest first.
+    Jobs may finish out of order; the source's watermark only advances over
+    the oldest contiguous run of completed items, so a failed item is
+    retried on the next poll.
+    """
+
+    def __init__(self, run: RepostRun, source: str, media_items: list):
+        self.run = run
+        self.source = source
+        self.media_items = media_items
+        self.completed = [False] * len(media_items)
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def complete(self, index: int):
+        """Mark an item handled and advance the watermark as far as possible."""
+        with self.lock:
+            self.completed[index] = True
+            while self.next_index < len(self.media_items) and self.completed[self.next_index]:
+                media = self.media_items[self.next_index]
+                seen_media.advance_watermark(
+                    self.run.user_id, self.source, media.pk, media.taken_at.timestamp()
+                )
+                self.next_index += 1
+
+class RepostJob:
+    """
+    A single media item to repost for a run, backed by a row in job_queue.
+    `slot` is the paced time (time.monotonic()) at which it may be uploaded,
+    and `lease` the token of the job's current lease, if any.
+    """
+
+    def __init__(self, batch: SourceBatch, index: int, media, job_id: int):
+        self.batch = batch
+        self.job_id = job_id
+        self.run = batch.run
+        self.index = index
+        self.media = media
+        self.paths = None
+        self.lease = None
+        self.slot = pacer.reserve(self.run.user_id)
+
+def check_and_repost(user_ids=None):
     """
     For each user with auto_repost enabled, log in to Instagram,
     check source accounts for new media, and repost supported content.
+    With user_ids, only those users are processed (the caller is expected to
+    have synced settings); otherwise settings are synced and every user is
+    considered.
+    Users run concurrently through the repost pipeline; the call returns
+    once every user has finished.
     """
-    for user_id, settings in user_settings.items():
-        if not settings.get("auto_repost"):
-            continue  # Skip if auto repost is off
+    if user_ids is None:
+        sync_settings()
+        user_ids = list(user_settings)
+    futures = {}
+    for user_id in user_ids:
+        future = submit_repost(user_id)
+        if future:
+            futures[future] = user_id
+    for future, user_id in futures.items():
+        try:
+            future.result()
+        except Exception as e:
+            logger.exception("Repost run for user %s failed: %s", user_id, e)
 
-        logger.info("Processing repost for user %s", user_id)
-        settings["last_repost_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        client = login_instagram(user_id)
-        if not client:
-            logger.error("Skipping user %s due to login failure", user_id)
-            continue
+def submit_repost(user_id: str):
+    """
+    Queue one user's repost run on the pipeline without waiting for it.
+    Returns a Future resolved when the run finishes, or None if the user
+    has auto_repost turned off.
+    """
+    settings = user_settings.get(user_id)
+    if not settings or not settings.get("auto_repost"):
+        return None  # Skip if auto repost is off
+    run = RepostRun(user_id, settings)
+    repost_pipeline.submit(run)
+    return run.future
+
+def content_enabled(settings: dict, media_type: int) -> bool:
+    """Return False if the user has this content type turned off."""
+    if media_type == 1:
+        return settings["supported_content"].get("photos", True)
+    if media_type == 2:
+        return settings["supported_content"].get("reels", True)
+    if media_type == 8:
+        return settings["supported_content"].get("carousels", True)
+    return False
 
-        for source in settings.get("source_accounts", []):
+def session_rejected(run: RepostRun, error):
+    """Drop a user's cached session and pooled client after Instagram rejected it."""
+    if run.session_valid:
+        run.session_valid = False
+        logger.error("Instagram session for user %s is no longer valid: %s", run.user_id, error)
+        sessions.invalidate(run.user_id)
+        client_pool.discard(run.user_id)
+
+def fetch_stage(run: RepostRun):
+    """
+    Pipeline stage 1: log in as the user, fetch new media from each source
+    and emit a job for every item that still has to be reposted.
+    When the rate limits stop it, the run goes back into the fetch queue
+    and later resumes with the source it was on.
+    """
+    user_id = run.user_id
+    requeued = False
+    try:
+        if not run.started:
+            run.started = True
+            logger.info("Processing repost for user %s", user_id)
+            run.settings["last_repost_time"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            store.update_fields(user_id, last_repost_time=run.settings["last_repost_time"])
+        if run.client is None:
+            login = login_key(user_id)
+            if not breakers.allow(login):
+                logger.info("Skipping user %s: login is backing off after failures", user_id)
+                return
             try:
-                # Fetch recent media (latest 5 posts) from the source account
-                media_items = client.user_medias_gql(source, 5)
-                for media in media_items:
-                    media_type = media.media_type  # 1 = Photo, 2 = Video, 8 = Carousel
-                    if media_type == 1 and not settings["supported_content"].get("photos", True):
-                        continue
-                    if media_type == 2 and not settings["supported_content"].get("reels", True):
-                        continue
-                    if media_type == 8 and not settings["supported_content"].get("carousels", True):
-                        continue
-
-                    # Prepare caption
-                    caption = media.caption_text if settings.get("use_original_caption") else settings.get("custom_caption", "")
-
-                    # Anti-detection delay (could be randomized)
-                    time.sleep(5)
-
-                    # Repost depending on media type
-                    if media_type in [1, 8]:
-                        filename = client.photo_download(media.pk)
-                        client.photo_upload(filename, caption)
-                        logger.info("Reposted photo/carousel from %s", source)
-                    elif media_type == 2:
-                        filename = client.video_download(media.pk)
-                        client.video_upload(filename, caption)
-                        logger.info("Reposted video (Reel) from %s", source)
+                run.client = login_instagram(user_id)
+            except RateLimited as e:
+                requeued = requeue_fetch(run, e)
+                return
+            except TRANSIENT_ERRORS as e:
+                logger.error("Skipping user %s: login interrupted: %s", user_id, e)
+                return
             except Exception as e:
-                logger.error("Error processing source %s for user %s: %s", source, user_id, e)
-        save_settings()
+                logger.error("Skipping user %s due to login failure", user_id)
+                breakers.record_failure(login, e)
+                return
+            finally:
+                breakers.release_probe(login)
+            breakers.record_success(login)
+
+        while run.next_source < len(run.sources) and run.session_valid:
+            source = run.sources[run.next_source]
+            # Fetch only media newer than the last item handled for this source
+            watermark = seen_media.watermark(user_id, source)
+            media_items = []
+            key = source_key(source)
+            if breakers.allow(key):  # Otherwise still backing off
+                try:
+                    media_items = fetch_new_media(run.client, source, watermark, run.keys)
+                    breakers.record_success(key)
+                except RateLimited as e:
+                    requeued = requeue_fetch(run, e)
+                    return
+                except LoginRequired as e:
+                    session_rejected(run, e)
+                    break
+                except SOURCE_ERRORS as e:
+                    logger.error("Source %s is unavailable for user %s: %s", source, user_id, e)
+                    breakers.record_failure(key, e)
+                except Exception as e:
+                    # Throttling, network trouble or a problem with this user's
+                    # client or proxy: not the source's fault, so other users
+                    # following it are not held back.
+                    logger.error("Error processing source %s for user %s: %s", source, user_id, e)
+                finally:
+                    breakers.release_probe(key)
+            run.next_source += 1
+            media_items, resumed = with_unfinished_jobs(user_id, source, watermark, media_items)
+            yield from source_jobs(run, source, media_items, resumed)
+    finally:
+        if not requeued:
+            run.done()
+
+def requeue_fetch(run: RepostRun, limited: RateLimited) -> bool:
+    """Put a run's fetch step back in the fetch queue until the rate limits allow it."""
+    logger.info("User %s is rate limited; resuming in %.0fs", run.user_id, limited.wait)
+    run.ready_at = time.monotonic() + limited.wait
+    fetch_queue.requeue(run, run.ready_at)
+    return True
+
+def with_unfinished_jobs(user_id: str, source: str, watermark, media_items: list):
+    """
+    Merge media from jobs left unfinished by an earlier run (e.g. before a
+    restart) into freshly fetched media, oldest first. Resumed jobs do not
+    depend on the fetch succeeding. Returns (media items, resumed pks).
+    """
+    fetched = {str(media.pk) for media in media_items}
+    resumed = set()
+    for media_pk, payload in job_queue.unfinished(user_id, source):
+        resumed.add(media_pk)
+        if media_pk in fetched:
+            continue
+        try:
+            media = Media.model_validate_json(payload)
+        except ValueError as e:
+            logger.warning("Cannot resume media %s for user %s: %s", media_pk, user_id, e)
+            continue
+        if watermark is not None and media.taken_at.timestamp() <= watermark:
+            job_queue.complete_media(user_id, source, media_pk)  # Handled before the restart
+            continue
+        media_items.append(media)
+    if len(media_items) > len(fetched):
+        media_items.sort(key=lambda media: media.taken_at)
+    return media_items, resumed
+
+def source_jobs(run: RepostRun, source: str, media_items: list, resumed: set):
+    """Queue a job for every item from a source that still has to be reposted."""
+    user_id = run.user_id
+    batch = SourceBatch(run, source, media_items)
+    for index, media in enumerate(media_items):
+        if (seen_media.contains(user_id, source, media.pk)
+                or not content_enabled(run.settings, media.media_type)):
+            if str(media.pk) in resumed:
+                job_queue.complete_media(user_id, source, media.pk)
+            batch.complete(index)
+            continue
+        job_id, state = job_queue.enqueue(
+            user_id, source, media.pk, media.taken_at.timestamp(), media.model_dump_json()
+        )
+        if state in (DONE, FAILED):
+            batch.complete(index)  # Finished or given up on by an earlier run
+            continue
+        run.add()
+        yield RepostJob(batch, index, media, job_id)
+
+def job_failed(job: RepostJob, error):
+    """
+    Record a failed download or upload. Once a job has used up its attempts
+    it counts as handled, so the source's watermark can move past it.
+    """
+    if job_queue.fail(job.job_id, job.lease, error) == FAILED:
+        logger.warning("Giving up on media %s from %s for user %s",
+                       job.media.pk, job.batch.source, job.run.user_id)
+        job.batch.complete(job.index)
+
+def download_stage(job: RepostJob):
+    """Pipeline stage 2: download the job's media into the shared cache."""
+    if download_job(job):
+        yield job
+
+def download_job(job: RepostJob) -> bool:
+    """
+    Claim a job and download its media. Returns True if the job goes on to
+    the upload stage. Otherwise the job is finished for this run, or was put
+    back into the download queue by the rate limits.
+    """
+    run, media = job.run, job.media
+    finished = True
+    try:
+        job.lease = job_queue.claim(job.job_id, DOWNLOADING)
+        if job.lease is None:
+            logger.info("Media %s for user %s is being handled by another worker", media.pk, run.user_id)
+            return False
+        if not run.session_valid:
+            raise LoginRequired("Session rejected earlier in this run")
+        if media.media_type == 2:
+            download = lambda folder: call_instagram(run.keys, run.client.video_download, media.pk, folder)
+        elif media.media_type == 8:
+            download = lambda folder: download_album(run.client, media, folder, run.keys)
+        else:
+            download = lambda folder: call_instagram(run.keys, run.client.photo_download, media.pk, folder)
+        job.paths = media_cache.pin(media.pk, download)
+        finished = False
+        return True
+    except RateLimited as e:
+        job_queue.release(job.job_id, job.lease)
+        download_queue.requeue(job, time.monotonic() + e.wait)
+        finished = False
+    except LoginRequired as e:
+        session_rejected(run, e)
+        job_queue.release(job.job_id, job.lease)
+    except Exception as e:
+        logger.error("Error downloading media %s from %s for user %s: %s",
+                     media.pk, job.batch.source, run.user_id, e)
+        job_failed(job, e)
+    finally:
+        if finished:
+            run.done()
+    return False
+
+def download_album(client, media, folder, keys: list) -> list:
+    """
+    Download every slide of a carousel into `folder` concurrently and return
+    the paths in slide order. Slides are fetched straight from their CDN
+    URLs, which the fetched media already carries; without them the whole
+    album is downloaded through the API instead.
+    """
+    if not media.resources:
+        return call_instagram(keys, client.album_download, media.pk, folder)
+    # The *_by_url downloads fetch with plain requests.get and leave the
+    # client's state alone, so they run in parallel without its lock.
+    futures = []
+    for index, resource in enumerate(media.resources):
+        filename = "%s_%02d" % (media.pk, index)
+        if resource.media_type == 2:
+            futures.append(album_downloader.submit(
+                client.video_download_by_url, resource.video_url, filename, folder))
+        else:
+            futures.append(album_downloader.submit(
+                client.photo_download_by_url, resource.thumbnail_url, filename, folder))
+    return [future.result() for future in futures]
+
+def upload_stage(job: RepostJob):
+    """
+    Pipeline stage 3: upload the downloaded media to the destination account.
+    A job whose account is busy uploading, or uploaded too recently, goes
+    back into the queue with a later ready time instead of holding a worker.
+    """
+    wait = pacer.begin(job.run.user_id)
+    if wait > 0:
+        job.slot = time.monotonic() + wait
+        upload_queue.requeue(job, job.slot)
+        return
+    try:
+        upload_job(job)
+    finally:
+        pacer.finish(job.run.user_id)
+
+def upload_job(job: RepostJob):
+    """
+    Upload one job's media, then record it as reposted. A job stopped by the
+    rate limits goes back into the upload queue, keeping its files pinned.
+    """
+    run, media, source = job.run, job.media, job.batch.source
+    requeued = False
+    try:
+        if not run.session_valid:
+            raise LoginRequired("Session rejected earlier in this run")
+        job.lease = job_queue.claim(job.job_id, UPLOADING, job.lease)  # Renews the download's lease
+        if job.lease is None:
+            logger.warning("Lease on media %s for user %s was lost", media.pk, run.user_id)
+            return
+        upload_once(run, job)
+        seen_media.add(run.user_id, source, media.pk)
+        job_queue.complete(job.job_id)
+        job.batch.complete(job.index)
+        logger.info("Reposted media %s from %s for user %s", media.pk, source, run.user_id)
+    except RateLimited as e:
+        job_queue.release(job.job_id, job.lease)
+        job.slot = time.monotonic() + e.wait
+        upload_queue.requeue(job, job.slot)
+        requeued = True
+    except LoginRequired as e:
+        session_rejected(run, e)
+        job_queue.release(job.job_id, job.lease)
+    except Exception as e:
+        logger.error("Error uploading media %s from %s for user %s: %s",
+                     media.pk, source, run.user_id, e)
+        job_failed(job, e)
+    finally:
+        if not requeued:
+            try:
+                media_cache.release(media.pk)
+            finally:
+                run.done()
+
+def upload_once(run: RepostRun, job: RepostJob):
+    """
+    Upload a job's media unless an earlier attempt already posted it.
+    The intent is written to the ledger before uploading and the resulting
+    destination media id after. A confirmed upload (the job failed or the
+    process died before it was marked done) is never repeated, and an
+    intent left unconfirmed (the upload timed out or the process died) is
+    first looked for among the destination account's latest posts.
+    """
+    user_id, source, media = run.user_id, job.batch.source, job.media
+    posted = upload_ledger.confirmed(user_id, source, media.pk)
+    if posted is not None:
+        logger.info("Media %s from %s was already posted for user %s as %s",
+                    media.pk, source, user_id, posted)
+        return
+    caption = repost_caption(run.settings, media)
+    unconfirmed = upload_ledger.unconfirmed(user_id, source, media.pk)
+    if unconfirmed:
+        posted = find_posted(run, *unconfirmed)
+        if posted is not None:
+            logger.info("Media %s from %s was already posted for user %s as %s",
+                        media.pk, source, user_id, posted)
+            upload_ledger.confirm(user_id, source, media.pk, posted)
+            return
+    upload_ledger.begin(user_id, source, media.pk, caption)
+    try:
+        result = upload_media(run.client, run.settings, media, job.paths, run.keys)
+    except RateLimited:
+        upload_ledger.abandon(user_id, source, media.pk)  # Refused before the upload started
+        raise
+    upload_ledger.confirm(user_id, source, media.pk, result.pk)
+
+def find_posted(run: RepostRun, caption: str, started_at: float):
+    """
+    Return the pk of a post among the destination's latest RECONCILE_DEPTH
+    that matches an unconfirmed upload (same caption, posted after it
+    started, not claimed by another upload), or None.
+    """
+    recent = call_instagram(run.keys, run.client.user_medias, run.client.user_id, RECONCILE_DEPTH)
+    for post in recent:
+        if (post.taken_at.timestamp() >= started_at - RECONCILE_SLACK
+                and (post.caption_text or "").strip() == caption.strip()
+                and not upload_ledger.is_recorded(run.user_id, post.pk)):
+            return post.pk
+    return None
+
+def repost_caption(settings: dict, media) -> str:
+    """Return the caption a media item is reposted with."""
+    if settings.get("use_original_caption"):
+        return media.caption_text or ""
+    return settings.get("custom_caption", "")
+
+def upload_media(client, settings: dict, media, paths: list, keys: list):
+    """
+    Upload downloaded media to the destination account with the user's caption.
+    Returns the destination Media.
+    """
+    caption = repost_caption(settings, media)
+
+    # Repost depending on media type
+    if media.media_type == 8 and len(paths) > 1:
+        return call_instagram(keys, client.album_upload, paths, caption)
+    if media.media_type == 2 or paths[0].suffix == ".mp4":
+        return call_instagram(keys, client.video_upload, paths[0], caption)
+    return call_instagram(keys, client.photo_upload, paths[0], caption)
+
+def finish_run(run: RepostRun):
+    """Persist cookies refreshed during a run that kept a valid session."""
+    if run.client and run.session_valid:
+        with client_lock(run.client):
+            session = run.client.get_settings()
+        sessions.save(run.user_id, run.settings["instagram_username"], session)
+
+# Runs are small and the scheduler must never block submitting them; a run
+# stopped by the rate limits waits here until it may continue.
+fetch_queue = DelayQueue(0, lambda run: run.ready_at)
+# Jobs wait here, holding only metadata, until shortly before their paced
+# upload slot, so files are not downloaded long before they are needed and a
+# busy account never blocks jobs for other accounts.
+download_queue = DelayQueue(0, lambda job: job.slot - DOWNLOAD_LEAD)
+# Downloaded jobs wait here until their paced upload slot.
+upload_queue = DelayQueue(STAGE_QUEUE_SIZE, lambda job: job.slot)
+
+repost_pipeline = Pipeline(
+    Stage("fetch", fetch_stage, FETCH_WORKERS, inbound=fetch_queue),
+    Stage("download", download_stage, DOWNLOAD_WORKERS, inbound=download_queue),
+    # Downloaded jobs are released to the uploaders when their slot arrives.
+    Stage("upload", upload_stage, UPLOAD_WORKERS, inbound=upload_queue),
+)
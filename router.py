@@ -0,0 +1,109 @@
+"""
+router.py - Callback Query Router
+----------------------------------
+This module maps inline-button callback_data to handlers:
+- Exact keys ("view_logs") are looked up in a dict.
+- Prefixes ("remove_source:") are kept in a character trie; the longest
+  registered prefix of the payload wins and the rest of the payload is
+  passed to the handler as its argument.
+Dispatch therefore costs one dict lookup, or one walk over the payload,
+however many routes are registered. The time spent in each route is
+recorded so slow menus can be spotted.
+"""
+
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class RouteStats:
+    """Call count and time spent in one route."""
+
+    __slots__ = ("calls", "total", "slowest")
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.slowest = 0.0
+
+
+class CallbackRouter:
+    """Routes callback_data to async handlers registered by exact key or by prefix."""
+
+    def __init__(self):
+        self.exact_routes = {}  # key -> handler
+        self.trie = {}          # char -> child node; a node's None key holds (prefix, handler)
+        self.stats = {}         # route name -> RouteStats
+        self.stats_lock = threading.Lock()
+
+    def exact(self, key: str):
+        """Decorator registering a handler for callback_data equal to `key`."""
+        def register(handler):
+            self.exact_routes[key] = handler
+            return handler
+        return register
+
+    def prefix(self, prefix: str):
+        """Decorator registering a handler for callback_data starting with `prefix`."""
+        def register(handler):
+            node = self.trie
+            for char in prefix:
+                node = node.setdefault(char, {})
+            node[None] = (prefix, handler)
+            return handler
+        return register
+
+    def resolve(self, data: str):
+        """
+        Return (route name, handler, argument) for a payload, or None.
+        Exact keys take precedence; otherwise the longest matching prefix is
+        used and the remainder of the payload is the argument.
+        """
+        handler = self.exact_routes.get(data)
+        if handler is not None:
+            return data, handler, None
+        match = None
+        node = self.trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            match = node.get(None, match)
+        if match is None:
+            return None
+        prefix, handler = match
+        return prefix, handler, data[len(prefix):]
+
+    async def dispatch(self, data: str, *args) -> bool:
+        """
+        Call the handler for a payload with `*args` followed by the parsed
+        argument (None for exact routes). Returns False if no route matches.
+        """
+        route = self.resolve(data)
+        if route is None:
+            logger.debug("No route for callback data %r", data)
+            return False
+        name, handler, argument = route
+        started = time.perf_counter()
+        try:
+            await handler(*args, argument)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.stats_lock:
+                stats = self.stats.get(name)
+                if stats is None:
+                    stats = self.stats[name] = RouteStats()
+                stats.calls += 1
+                stats.total += elapsed
+                stats.slowest = max(stats.slowest, elapsed)
+        return True
+
+    def timings(self) -> dict:
+        """Return {route name: (calls, total seconds, slowest seconds)}."""
+        with self.stats_lock:
+            return {
+                name: (stats.calls, stats.total, stats.slowest)
+                for name, stats in self.stats.items()
+            }
@@ -1,24 +1,222 @@
 """
 scheduler.py - Scheduler for Reposting Tasks
 ---------------------------------------------
-This script imports the check_and_repost function from repost.py
-and uses the schedule library to run it periodically.
+This script runs repost jobs from repost.py for each user when their
+repost interval has elapsed:
+- Users are kept in a heap ordered by their next due time
+  (last_repost_time + repost_interval), so only due users are touched.
+- Due times are rounded down to a shared REPOST_ALIGNMENT boundary, so
+  users following the same source poll it together and share one fetch.
+- The timing loop sleeps until exactly the next due time and wakes early
+  when settings change (e.g. a user turns auto_repost on).
+- Jobs are dispatched to the repost pipeline without blocking the loop,
+  so a long run does not delay other users that become due meanwhile.
+- A due user whose account is out of API rate-limit budget is pushed back
+  until the budget allows a call, instead of starting a run that would stall.
+- Finished repost jobs and confirmed uploads are purged once an hour.
+Run it standalone with run_scheduler(), or start it next to the bot in one
+process with start_scheduler() (see server.py).
 """
 
-import schedule
+import os
+import heapq
+import logging
+import threading
 import time
-from repost import check_and_repost
+from datetime import datetime
+from repost import (
+    job_queue,
+    next_allowed,
+    store,
+    submit_repost,
+    submit_resolve,
+    sync_settings,
+    upload_ledger,
+    user_settings,
+)
 
-def run_scheduler():
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for settings written by the bot process. The check
+# is a single PRAGMA when nothing changed.
+SETTINGS_POLL_INTERVAL = 2.0
+# Seconds between purges of finished jobs and confirmed uploads.
+JOB_PURGE_INTERVAL = 60 * 60
+# Due times are rounded down to a multiple of this many seconds. Keep it
+# below source_feed's SOURCE_FEED_TTL so one fetch covers a whole window.
+REPOST_ALIGNMENT = float(os.environ.get("REPOST_ALIGNMENT", "300"))
+
+def next_due_time(settings: dict, now: float) -> float:
+    """
+    Return when a user is next due: last_repost_time + repost_interval hours,
+    rounded down to a REPOST_ALIGNMENT boundary. Rounding down keeps a run
+    that starts a little after its boundary on the same boundary next time.
     """
-    Schedule check_and_repost to run periodically.
-    For demo purposes, this is set to every minute.
-    Adjust as needed for production.
+    last_repost = settings.get("last_repost_time")
+    if not last_repost:
+        return now
+    try:
+        last = datetime.strptime(last_repost, "%Y-%m-%d %H:%M:%S").timestamp()
+    except ValueError:
+        return now
+    due = last + float(settings.get("repost_interval") or 1) * 3600
+    if REPOST_ALIGNMENT > 0:
+        due -= due % REPOST_ALIGNMENT
+    return due
+
+class RepostQueue:
+    """
+    Min-heap of (due_time, user_id) for users with auto_repost enabled.
+    Rescheduling pushes a new entry and records it in `due_at`; older heap
+    entries for the same user are skipped when popped.
     """
-    schedule.every(1).minutes.do(check_and_repost)
+
+    def __init__(self):
+        self.heap = []
+        self.due_at = {}
+
+    def update(self, user_id: str, settings, now: float = None):
+        """(Re)schedule a user from their current settings."""
+        if not settings or not settings.get("auto_repost"):
+            self.due_at.pop(user_id, None)
+            return
+        self.schedule_at(user_id, next_due_time(settings, now if now is not None else time.time()))
+
+    def schedule_at(self, user_id: str, due: float):
+        """Schedule a user at an explicit time, replacing any earlier entry."""
+        if self.due_at.get(user_id) == due:
+            return
+        self.due_at[user_id] = due
+        heapq.heappush(self.heap, (due, user_id))
+
+    def pop_due(self, now: float) -> list:
+        """Remove and return the users whose due time has passed."""
+        due_users = []
+        while self.heap and self.heap[0][0] <= now:
+            due, user_id = heapq.heappop(self.heap)
+            if self.due_at.get(user_id) != due:
+                continue  # Superseded by a later update
+            del self.due_at[user_id]
+            due_users.append(user_id)
+        return due_users
+
+    def next_due(self):
+        """Return the earliest due time, or None if no user is scheduled."""
+        while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+
+class RepostScheduler:
+    """
+    Event-driven dispatcher for repost jobs.
+    All queue access happens under `cond`; the timing loop waits on it until
+    the next due time, and settings changes and finished jobs notify it.
+    """
+
+    def __init__(self):
+        self.queue = RepostQueue()
+        self.cond = threading.Condition()
+        self.running = set()
+
+    def settings_changed(self, user_ids):
+        """Reschedule users whose settings changed and wake the timing loop."""
+        now = time.time()
+        with self.cond:
+            for user_id in user_ids:
+                if user_id not in self.running:  # Rescheduled when its run finishes
+                    self.queue.update(user_id, user_settings.get(user_id), now)
+            self.cond.notify()
+
+    def _job_finished(self, user_id: str, future):
+        """Done-callback for a repost job: log failures and schedule the next run."""
+        error = future.exception()
+        if error:
+            logger.error("Repost run for user %s failed: %s", user_id, error)
+        with self.cond:
+            self.running.discard(user_id)
+            self.queue.update(user_id, user_settings.get(user_id))
+            self.cond.notify()
+
+    def _dispatch_due(self):
+        """Start a job for every due user; the caller holds `cond`."""
+        now = time.time()
+        for user_id in self.queue.pop_due(now):
+            wait = next_allowed(user_id)
+            if wait > 0:
+                self.queue.schedule_at(user_id, now + wait)
+                continue
+            future = submit_repost(user_id)
+            if future is None:
+                continue
+            self.running.add(user_id)
+            future.add_done_callback(
+                lambda future, user_id=user_id: self._job_finished(user_id, future)
+            )
+
+    def stats(self) -> dict:
+        """Return the number of scheduled and running users and the next due time."""
+        with self.cond:
+            return {
+                "scheduled": len(self.queue.due_at),
+                "running": len(self.running),
+                "next_due": self.queue.next_due(),
+            }
+
+    def run_forever(self):
+        """Timing loop: sleep until the next due time or a notification, then dispatch."""
+        with self.cond:
+            while True:
+                self._dispatch_due()
+                next_due = self.queue.next_due()
+                timeout = None if next_due is None else max(0.0, next_due - time.time())
+                self.cond.wait(timeout)
+
+def watch_settings(repost_scheduler: RepostScheduler):
+    """
+    Forward settings changes written by the bot process to the scheduler,
+    and purge finished jobs and uploads every JOB_PURGE_INTERVAL seconds.
+    """
+    last_purge = -JOB_PURGE_INTERVAL
     while True:
-        schedule.run_pending()
-        time.sleep(10)
+        time.sleep(SETTINGS_POLL_INTERVAL)
+        if time.monotonic() - last_purge >= JOB_PURGE_INTERVAL:
+            last_purge = time.monotonic()
+            try:
+                job_queue.purge()
+                upload_ledger.purge()
+            except Exception as e:
+                logger.error("Failed to purge finished jobs: %s", e)
+        try:
+            changed = sync_settings()
+        except Exception as e:
+            logger.error("Failed to poll settings changes: %s", e)
+            continue
+        if changed:
+            settings_changed(repost_scheduler, changed)
+
+def settings_changed(repost_scheduler: RepostScheduler, user_ids):
+    """Reschedule users whose settings changed and resolve newly added sources."""
+    repost_scheduler.settings_changed(user_ids)
+    submit_resolve(user_ids)  # Look up newly added sources before they are polled
+
+def start_scheduler() -> RepostScheduler:
+    """
+    Schedule every auto-repost user and start watching for settings changes,
+    both from other processes and from a bot running in this one. The caller
+    runs the returned scheduler's run_forever() loop.
+    """
+    sync_settings()
+    repost_scheduler = RepostScheduler()
+    settings_changed(repost_scheduler, list(user_settings))
+    store.add_listener(lambda user_ids: settings_changed(repost_scheduler, user_ids))
+    threading.Thread(
+        target=watch_settings, args=(repost_scheduler,), name="settings-watcher", daemon=True
+    ).start()
+    return repost_scheduler
+
+def run_scheduler():
+    """Schedule every auto-repost user and run the event-driven dispatch loop."""
+    start_scheduler().run_forever()
 
 if __name__ == "__main__":
     run_scheduler()
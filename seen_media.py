@@ -0,0 +1,125 @@
+"""
+seen_media.py - Index of Already Reposted Media
+------------------------------------------------
+This module remembers which source media each user has already reposted so
+check_and_repost never downloads or uploads the same post twice:
+- On disk: a compact WITHOUT ROWID table keyed by (user, source, media pk)
+  in the settings database.
+- In memory: a bounded LRU of hot sets holding the most recent pks for each
+  (user, source), giving O(1) membership checks on the repost path.
+- A high-water mark per (user, source): the timestamp of the newest media
+  already handled, so polls only need to fetch items newer than it.
+"""
+
+import time
+import logging
+import threading
+from collections import OrderedDict
+from storage import DB_FILE, connect
+
+logger = logging.getLogger(__name__)
+
+# Most recent pks kept in memory per (user, source).
+HOT_SET_SIZE = 200
+# Number of (user, source) hot sets kept in memory.
+HOT_SET_COUNT = 2048
+
+
+class SeenMediaIndex:
+    """Persistent set of reposted media pks per (user, source)."""
+
+    def __init__(self, path: str = DB_FILE):
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen_media ("
+            " user_id TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " media_pk TEXT NOT NULL,"
+            " seen_at REAL NOT NULL,"
+            " PRIMARY KEY (user_id, source, media_pk)"
+            ") WITHOUT ROWID"
+        )
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS source_watermarks ("
+            " user_id TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " media_pk TEXT NOT NULL,"
+            " taken_at REAL NOT NULL,"
+            " PRIMARY KEY (user_id, source)"
+            ") WITHOUT ROWID"
+        )
+        # (user_id, source) -> (pks, complete); `complete` means every
+        # stored pk for that key fit in the hot set, so a miss is authoritative.
+        self.hot = OrderedDict()
+
+    def _hot_set(self, key: tuple):
+        """Return the hot set for a key, loading it from disk on first use."""
+        entry = self.hot.get(key)
+        if entry is not None:
+            self.hot.move_to_end(key)
+            return entry
+        rows = self.conn.execute(
+            "SELECT media_pk FROM seen_media WHERE user_id = ? AND source = ? "
+            "ORDER BY seen_at DESC LIMIT ?",
+            (key[0], key[1], HOT_SET_SIZE + 1),
+        ).fetchall()
+        # A dict keeps insertion order, oldest first, so it can drop the oldest pk.
+        pks = dict.fromkeys(pk for (pk,) in reversed(rows[:HOT_SET_SIZE]))
+        entry = (pks, len(rows) <= HOT_SET_SIZE)
+        self.hot[key] = entry
+        if len(self.hot) > HOT_SET_COUNT:
+            self.hot.popitem(last=False)
+        return entry
+
+    def contains(self, user_id: str, source: str, media_pk) -> bool:
+        """Return True if this media was already reposted for the user and source."""
+        media_pk = str(media_pk)
+        with self.lock:
+            pks, complete = self._hot_set((user_id, source))
+            if media_pk in pks:
+                return True
+            if complete:
+                return False
+            row = self.conn.execute(
+                "SELECT 1 FROM seen_media WHERE user_id = ? AND source = ? AND media_pk = ?",
+                (user_id, source, media_pk),
+            ).fetchone()
+            return row is not None
+
+    def add(self, user_id: str, source: str, media_pk):
+        """Record that a media item has been reposted."""
+        media_pk = str(media_pk)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO seen_media (user_id, source, media_pk, seen_at) "
+                "VALUES (?, ?, ?, ?)",
+                (user_id, source, media_pk, time.time()),
+            )
+            pks, complete = self._hot_set((user_id, source))
+            pks[media_pk] = None
+            if len(pks) > HOT_SET_SIZE:
+                # Let the oldest pk fall back to disk lookups.
+                del pks[next(iter(pks))]
+                self.hot[(user_id, source)] = (pks, False)
+
+    def watermark(self, user_id: str, source: str):
+        """Return the taken_at timestamp of the newest handled media, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT taken_at FROM source_watermarks WHERE user_id = ? AND source = ?",
+                (user_id, source),
+            ).fetchone()
+        return row[0] if row else None
+
+    def advance_watermark(self, user_id: str, source: str, media_pk, taken_at: float):
+        """Move the watermark forward to a handled media item; never moves it back."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO source_watermarks (user_id, source, media_pk, taken_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id, source) DO UPDATE SET "
+                "media_pk = excluded.media_pk, taken_at = excluded.taken_at "
+                "WHERE excluded.taken_at > source_watermarks.taken_at",
+                (user_id, source, str(media_pk), taken_at),
+            )
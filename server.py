@@ -1,30 +1,227 @@
 """
-server.py - Dummy Web Server for Heroku & Telegram Bot Starter
-
-This file does two things:
-1. Runs a minimal Flask web server that binds to the port Heroku assigns.
-2. Starts the Telegram bot (defined in main.py) in a separate thread.
+server.py - Single-Process Runtime for Heroku
+----------------------------------------------
+This file runs everything in one process, on one asyncio event loop:
+1. The Telegram bot (defined in main.py). It receives updates by polling,
+   or, when TELEGRAM_WEBHOOK_URL is set, by webhook on the same port as the
+   HTTP server, so a single Heroku web dyno serves both.
+2. The repost scheduler (defined in scheduler.py). Its timing loop runs in
+   a background thread and Instagram calls run on the repost pipeline's
+   worker threads, so blocking instagrapi calls never stall the loop.
+3. A lightweight HTTP server on the port Heroku assigns, serving a health
+   check and metrics.
+The bot and the scheduler share the same in-memory settings, and settings
+changed in the bot reach the scheduler immediately.
 """
 
 import os
+import hmac
+import json
+import time
+import signal
 import asyncio
-from flask import Flask
-import main  # Ensure this imports your Telegram bot's main module
+import logging
+import threading
+import main
+from telegram import Update
+from scheduler import start_scheduler
 
-app = Flask(__name__)
+logger = logging.getLogger(__name__)
 
-@app.route('/')
-def index():
-    return "Instagram Reposting Bot is running!"
+# Seconds a client may take to send its request before the connection is dropped.
+REQUEST_TIMEOUT = 10
+# Largest request body accepted.
+MAX_BODY = 1024 * 1024
 
-async def run_bot():
-    await main.main()
+STATUS_TEXT = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    413: "Payload Too Large",
+    503: "Service Unavailable",
+}
 
-if __name__ == '__main__':
-    # Run the bot in the main thread's event loop
-    loop = asyncio.get_event_loop()
-    loop.create_task(run_bot())
 
-    # Bind to the port assigned by Heroku
-    port = int(os.environ.get("PORT", 5000))
-    app.run(host="0.0.0.0", port=port)
+class Runtime:
+    """The bot, the scheduler and the HTTP server sharing one event loop."""
+
+    def __init__(self, token: str, webhook_url: str = None):
+        self.app = main.build_application(token)
+        self.webhook_url = webhook_url
+        self.scheduler = None
+        self.started_at = time.time()
+        self.updates_received = 0
+        self.routes = {
+            ("GET", "/"): self.index,
+            ("GET", "/health"): self.health,
+            ("GET", "/metrics"): self.metrics,
+        }
+        if webhook_url:
+            self.routes[("POST", main.WEBHOOK_PATH)] = self.telegram_update
+            if not main.WEBHOOK_SECRET:
+                logger.warning("TELEGRAM_WEBHOOK_SECRET is not set; webhook posts are not authenticated")
+
+    async def index(self, headers: dict, body: bytes):
+        return 200, "text/plain", "Instagram Reposting Bot is running!"
+
+    async def health(self, headers: dict, body: bytes):
+        healthy = self.app.running and self.scheduler is not None
+        return (200 if healthy else 503), "application/json", json.dumps(
+            {"status": "ok" if healthy else "starting"}
+        )
+
+    async def metrics(self, headers: dict, body: bytes):
+        stats = self.scheduler.stats() if self.scheduler else {"scheduled": 0, "running": 0}
+        users = list(main.user_settings.values())
+        lines = [
+            "bot_uptime_seconds %d" % (time.time() - self.started_at),
+            "bot_users %d" % len(users),
+            "bot_users_auto_repost %d" % sum(1 for settings in users if settings.get("auto_repost")),
+            "scheduler_users_scheduled %d" % stats["scheduled"],
+            "scheduler_runs_in_progress %d" % stats["running"],
+            "telegram_webhook_updates %d" % self.updates_received,
+            "keyboard_cache_hits %d" % main.keyboards.hits,
+            "keyboard_cache_misses %d" % main.keyboards.misses,
+        ]
+        for route, (calls, total, slowest) in sorted(main.router.timings().items()):
+            lines.append('callback_route_calls{route="%s"} %d' % (route, calls))
+            lines.append('callback_route_seconds_total{route="%s"} %.6f' % (route, total))
+            lines.append('callback_route_seconds_max{route="%s"} %.6f' % (route, slowest))
+        return 200, "text/plain; version=0.0.4", "\n".join(lines) + "\n"
+
+    async def telegram_update(self, headers: dict, body: bytes):
+        """Webhook endpoint: hand an update posted by Telegram to the bot."""
+        # Compared as bytes: compare_digest rejects non-ASCII str, and headers
+        # are decoded as latin-1, which encode() reverses exactly.
+        if main.WEBHOOK_SECRET and not hmac.compare_digest(
+            headers.get("x-telegram-bot-api-secret-token", "").encode("latin-1"),
+            main.WEBHOOK_SECRET.encode(),
+        ):
+            return 403, "text/plain", "Forbidden"
+        try:
+            data = json.loads(body)
+        except ValueError:
+            return 400, "text/plain", "Bad Request"
+        if not isinstance(data, dict):
+            return 400, "text/plain", "Bad Request"
+        try:
+            update = Update.de_json(data, self.app.bot)
+        except Exception as e:
+            logger.warning("Rejected malformed webhook update: %s", e)
+            return 400, "text/plain", "Bad Request"
+        if update is None:
+            return 400, "text/plain", "Bad Request"
+        self.updates_received += 1
+        await self.app.update_queue.put(update)
+        return 200, "text/plain", "OK"
+
+    async def handle_http(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Serve one HTTP/1.0-style request per connection."""
+        try:
+            try:
+                method, path, headers, body = await asyncio.wait_for(
+                    read_request(reader), REQUEST_TIMEOUT
+                )
+            except RequestTooLarge:
+                status, content_type, text = 413, "text/plain", "Payload Too Large"
+            except (ValueError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                status, content_type, text = 400, "text/plain", "Bad Request"
+            else:
+                handler = self.routes.get((method, path.split("?", 1)[0]))
+                if handler is None:
+                    status, content_type, text = 404, "text/plain", "Not Found"
+                else:
+                    status, content_type, text = await handler(headers, body)
+            writer.write(render_response(status, content_type, text))
+            await writer.drain()
+        except ConnectionError:
+            pass
+        except Exception as e:
+            logger.exception("Error serving HTTP request: %s", e)
+        finally:
+            writer.close()
+
+    async def run(self, port: int):
+        """Start everything, wait for SIGINT/SIGTERM, then shut down cleanly."""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop.set)
+
+        server = await asyncio.start_server(self.handle_http, main.LISTEN_ADDR, port)
+        logger.info("HTTP server listening on %s:%d", main.LISTEN_ADDR, port)
+        await self.app.initialize()
+        await self.app.start()
+        if self.webhook_url:
+            await self.app.bot.set_webhook(
+                url=self.webhook_url.rstrip("/") + main.WEBHOOK_PATH,
+                secret_token=main.WEBHOOK_SECRET,
+            )
+            logger.info("Receiving updates by webhook at %s", main.WEBHOOK_PATH)
+        else:
+            await self.app.updater.start_polling()
+
+        # start_scheduler() syncs settings and may touch the database, so it
+        # runs off the loop; the timing loop gets a thread of its own.
+        self.scheduler = await loop.run_in_executor(None, start_scheduler)
+        threading.Thread(target=self.scheduler.run_forever, name="scheduler", daemon=True).start()
+
+        try:
+            await stop.wait()
+        finally:
+            logger.info("Shutting down")
+            server.close()
+            await server.wait_closed()
+            if self.app.updater.running:
+                await self.app.updater.stop()
+            await self.app.stop()
+            await self.app.shutdown()
+
+
+class RequestTooLarge(ValueError):
+    """Raised when a request body exceeds MAX_BODY."""
+
+
+async def read_request(reader: asyncio.StreamReader):
+    """Read one HTTP request; return (method, path, headers, body)."""
+    request_line = (await reader.readline()).decode("latin-1").split()
+    if len(request_line) < 2:
+        raise ValueError("Malformed request line")
+    method, path = request_line[0], request_line[1]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n"):
+            break
+        if not line:
+            raise asyncio.IncompleteReadError(line, None)
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length") or 0)
+    if length > MAX_BODY:
+        raise RequestTooLarge(length)
+    body = await reader.readexactly(length) if length else b""
+    return method, path, headers, body
+
+
+def render_response(status: int, content_type: str, text: str) -> bytes:
+    """Encode a complete HTTP response that closes the connection."""
+    payload = text.encode()
+    head = (
+        "HTTP/1.1 %d %s\r\n"
+        "Content-Type: %s\r\n"
+        "Content-Length: %d\r\n"
+        "Connection: close\r\n\r\n"
+    ) % (status, STATUS_TEXT[status], content_type, len(payload))
+    return head.encode("latin-1") + payload
+
+
+if __name__ == '__main__':
+    TELEGRAM_TOKEN = os.environ.get("TELEGRAM_TOKEN")
+    if not TELEGRAM_TOKEN:
+        logger.error("Telegram token not set in environment variables.")
+    else:
+        # Bind to the port assigned by Heroku
+        port = int(os.environ.get("PORT", 5000))
+        asyncio.run(Runtime(TELEGRAM_TOKEN, main.WEBHOOK_URL).run(port))
@@ -0,0 +1,64 @@
+"""
+sessions.py - Instagram Session Cache
+--------------------------------------
+This module persists each user's instagrapi session settings (cookies,
+device, uuids) in the settings database so the scheduler can reuse a
+logged-in session instead of performing a full login every cycle.
+Sessions are tied to the destination username; changing the account in the
+bot makes the cached session unusable.
+"""
+
+import json
+import time
+import logging
+import threading
+from storage import DB_FILE, connect
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """Per-user instagrapi session settings, with the time they were last validated."""
+
+    def __init__(self, path: str = DB_FILE):
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS instagram_sessions ("
+            " user_id TEXT PRIMARY KEY,"
+            " username TEXT NOT NULL,"
+            " settings TEXT NOT NULL,"
+            " validated_at REAL NOT NULL)"
+        )
+
+    def load(self, user_id: str, username: str):
+        """
+        Return (settings, validated_at) for the user's cached session,
+        or None if there is none for this username.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT settings, validated_at FROM instagram_sessions "
+                "WHERE user_id = ? AND username = ?",
+                (user_id, username),
+            ).fetchone()
+        if not row:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def save(self, user_id: str, username: str, settings: dict, validated_at: float = None):
+        """Store the session settings of a client that is known to be logged in."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO instagram_sessions (user_id, username, settings, validated_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET username = excluded.username, "
+                "settings = excluded.settings, validated_at = excluded.validated_at",
+                (user_id, username, json.dumps(settings), validated_at or time.time()),
+            )
+
+    def invalidate(self, user_id: str):
+        """Forget a user's session, forcing a full login next time."""
+        with self.lock:
+            self.conn.execute("DELETE FROM instagram_sessions WHERE user_id = ?", (user_id,))
+        logger.info("Dropped cached Instagram session for user %s", user_id)
@@ -0,0 +1,108 @@
+"""
+source_feed.py - Shared Source Media Fetches
+---------------------------------------------
+When many users follow the same source account, this module makes one
+upstream fetch serve all of them:
+- Concurrent requests for a source wait for a single in-flight fetch.
+- A fetched page stays fresh for SOURCE_FEED_TTL, so users due in the same
+  scheduling window reuse it instead of fetching the source again. Repost
+  intervals are in hours, so a few minutes of staleness only delays a
+  brand new post to the user's next poll.
+- Each entry remembers how far back it is complete, so a user whose
+  watermark is older than that triggers a deeper fetch instead of missing posts.
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Seconds a fetched media list is reused for other users of the same source.
+FEED_TTL = float(os.environ.get("SOURCE_FEED_TTL", "900"))
+# covered_since of an entry holding the source's entire feed, e.g. a source
+# with fewer posts than were asked for.
+ALL_MEDIA = float("-inf")
+
+
+class FeedEntry:
+    """Media fetched from one source and the range it covers."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.items = []              # Oldest first
+        self.covered_since = None    # Every item with taken_at > this is present
+        self.fetched_at = 0.0
+        self.error = None
+
+    def serves(self, watermark, initial_count: int, ttl: float) -> bool:
+        """Return True if this entry can answer a request without fetching."""
+        if self.error or time.monotonic() - self.fetched_at > ttl:
+            return False
+        if watermark is None:
+            return len(self.items) >= initial_count or self.covered_since == ALL_MEDIA
+        return self.covered_since is not None and watermark >= self.covered_since
+
+
+class SourceFeed:
+    """Single-flight, short-lived cache of source media lists."""
+
+    def __init__(self, ttl: float = FEED_TTL):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.fetches = 0
+        self.requests = 0
+
+    def get(self, source: str, watermark, initial_count: int, fetch):
+        """
+        Return the source's media newer than the watermark, oldest first, or
+        the latest initial_count items when there is no watermark.
+        `fetch(watermark)` performs the upstream call and returns
+        (items oldest first, covered_since); it is called at most once per
+        source at a time, by the first requester.
+        """
+        with self.lock:
+            self.requests += 1
+        while True:
+            with self.lock:
+                entry = self.entries.get(source)
+                if entry is not None and not entry.done.is_set():
+                    waiting_for = entry
+                elif entry is not None and entry.serves(watermark, initial_count, self.ttl):
+                    return self._select(entry, watermark, initial_count)
+                else:
+                    self._evict_stale()
+                    entry = FeedEntry()
+                    self.entries[source] = entry
+                    self.fetches += 1
+                    break
+            waiting_for.done.wait()
+            if waiting_for.error is None and waiting_for.serves(watermark, initial_count, self.ttl):
+                return self._select(waiting_for, watermark, initial_count)
+
+        try:
+            entry.items, entry.covered_since = fetch(watermark)
+        except Exception as e:
+            entry.error = e
+            raise
+        finally:
+            entry.fetched_at = time.monotonic()
+            entry.done.set()
+        return self._select(entry, watermark, initial_count)
+
+    def _select(self, entry: FeedEntry, watermark, initial_count: int) -> list:
+        """Pick the items a single requester should see."""
+        if watermark is None:
+            return entry.items[-initial_count:]
+        return [media for media in entry.items if media.taken_at.timestamp() > watermark]
+
+    def _evict_stale(self):
+        """Drop finished entries older than the TTL; the caller holds the lock."""
+        cutoff = time.monotonic() - self.ttl
+        for source in [
+            source for source, entry in self.entries.items()
+            if entry.done.is_set() and entry.fetched_at < cutoff
+        ]:
+            del self.entries[source]
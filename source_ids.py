@@ -0,0 +1,108 @@
+"""
+source_ids.py - Source Username to User ID Cache
+-------------------------------------------------
+Instagram's media endpoints take numeric user ids, while users add source
+accounts by username. This module keeps a persistent username -> pk cache:
+- Resolved ids are kept for SOURCE_ID_TTL and then refreshed in the
+  background the next time they are used.
+- Usernames that do not exist or are private are cached negatively for
+  NEGATIVE_TTL, so they are not looked up again on every poll.
+- The bot registers new sources as pending when they are added, and can
+  reject a username already known not to exist.
+"""
+
+import time
+import logging
+import threading
+from storage import DB_FILE, connect
+
+logger = logging.getLogger(__name__)
+
+SOURCE_ID_TTL = 7 * 24 * 60 * 60
+NEGATIVE_TTL = 6 * 60 * 60
+
+PENDING = "pending"
+RESOLVED = "resolved"
+NOT_FOUND = "not_found"
+PRIVATE = "private"
+NEGATIVE_STATUSES = (NOT_FOUND, PRIVATE)
+
+
+class SourceUnavailable(Exception):
+    """Raised when a source account does not exist or cannot be read."""
+
+
+def normalize_username(username: str) -> str:
+    """Instagram usernames are case-insensitive; also drop a leading @."""
+    return username.strip().lstrip("@").lower()
+
+
+class SourceIdCache:
+    """Persistent username -> user pk mapping with positive and negative TTLs."""
+
+    def __init__(self, path: str = DB_FILE):
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS source_ids ("
+            " username TEXT PRIMARY KEY,"
+            " user_pk TEXT,"
+            " status TEXT NOT NULL,"
+            " resolved_at REAL NOT NULL)"
+        )
+        self.memory = {}  # username -> (user_pk, status, resolved_at)
+
+    def get(self, username: str):
+        """Return (user_pk, status, resolved_at) for a username, or None."""
+        username = normalize_username(username)
+        with self.lock:
+            entry = self.memory.get(username)
+            if entry is None:
+                row = self.conn.execute(
+                    "SELECT user_pk, status, resolved_at FROM source_ids WHERE username = ?",
+                    (username,),
+                ).fetchone()
+                if row is None:
+                    return None
+                entry = tuple(row)
+                if entry[1] != PENDING:  # Pending rows are resolved by another process
+                    self.memory[username] = entry
+            return entry
+
+    def is_fresh(self, entry) -> bool:
+        """Return True if a cached entry can be used without looking it up again."""
+        user_pk, status, resolved_at = entry
+        if status == RESOLVED:
+            return time.time() - resolved_at < SOURCE_ID_TTL
+        if status in NEGATIVE_STATUSES:
+            return time.time() - resolved_at < NEGATIVE_TTL
+        return False
+
+    def known_unavailable(self, username: str) -> bool:
+        """Return True if the username is cached as nonexistent or private."""
+        entry = self.get(username)
+        return entry is not None and entry[1] in NEGATIVE_STATUSES and self.is_fresh(entry)
+
+    def request(self, username: str):
+        """Register a newly added source so it is resolved ahead of its first poll."""
+        username = normalize_username(username)
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO source_ids (username, user_pk, status, resolved_at) "
+                "VALUES (?, NULL, ?, 0)",
+                (username, PENDING),
+            )
+
+    def store(self, username: str, user_pk, status: str):
+        """Record the outcome of a lookup."""
+        username = normalize_username(username)
+        entry = (str(user_pk) if user_pk is not None else None, status, time.time())
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO source_ids (username, user_pk, status, resolved_at) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(username) DO UPDATE SET user_pk = excluded.user_pk, "
+                "status = excluded.status, resolved_at = excluded.resolved_at",
+                (username,) + entry,
+            )
+            self.memory[username] = entry
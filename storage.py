@@ -0,0 +1,329 @@
+"""
+storage.py - SQLite Settings Store
+-----------------------------------
+This module keeps per-user settings in a local SQLite database:
+- One row per user, stored as a JSON document.
+- WAL journal mode so the bot and the scheduler can read while the other writes.
+- Each save is a single-row upsert instead of a rewrite of every user's settings.
+- Changes can be written behind: a burst of updates to one user is coalesced
+  and flushed once by a background thread (and on exit).
+- The legacy user_settings.json file is imported on first start.
+- Every write stamps the row with an increasing sequence number, so another
+  process can pull just the users that changed since its last poll.
+- Listeners in the same process are told about saves right away.
+
+Crash safety comes from SQLite's write-ahead log: every write appends only the
+changed row to the log, the log is replayed automatically when the database is
+opened, and a torn final write is discarded on its own. fsyncs are batched
+(synchronous=NORMAL) and the log is compacted back into the database file by a
+background checkpoint instead of on the write path.
+"""
+
+import os
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+DB_FILE = os.environ.get("SETTINGS_DB", "user_settings.db")
+LEGACY_SETTINGS_FILE = "user_settings.json"
+# Seconds to wait after the first change before flushing, so bursts are coalesced.
+FLUSH_INTERVAL = float(os.environ.get("SETTINGS_FLUSH_INTERVAL", "1.0"))
+# Seconds between background checkpoints that fold the WAL into the database file.
+COMPACT_INTERVAL = float(os.environ.get("SETTINGS_COMPACT_INTERVAL", "300"))
+# Safety net: pages the WAL may grow to before a writer checkpoints inline.
+WAL_AUTOCHECKPOINT_PAGES = 10000
+# Fields written only by the scheduler. Whole-row saves from the bot keep the
+# stored value, so a bot save never rolls back the scheduler's updates.
+SCHEDULER_FIELDS = ("last_repost_time",)
+
+NEXT_SEQ = "(SELECT COALESCE(MAX(seq), 0) + 1 FROM user_settings)"
+UPSERT_SQL = (
+    "INSERT INTO user_settings (user_id, data, seq) VALUES (?, ?, " + NEXT_SEQ + ") "
+    "ON CONFLICT(user_id) DO UPDATE SET data = "
+    + "json_set(excluded.data"
+    + "".join(
+        ", '$.%s', json_extract(user_settings.data, '$.%s')" % (field, field)
+        for field in SCHEDULER_FIELDS
+    )
+    + "), seq = " + NEXT_SEQ + " RETURNING seq"
+)
+
+
+def merge_scheduler_fields(current: dict, stored: dict) -> bool:
+    """Copy SCHEDULER_FIELDS from a stored row into `current`; return True if any changed."""
+    merged = False
+    for field in SCHEDULER_FIELDS:
+        if field in stored and current.get(field) != stored[field]:
+            current[field] = stored[field]
+            merged = True
+    return merged
+
+
+def connect(path: str = DB_FILE) -> sqlite3.Connection:
+    """
+    Open a SQLite connection configured for this bot.
+    The connection runs in autocommit mode, so every statement is its own
+    transaction, and may be shared between threads (callers hold a lock).
+    """
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA wal_autocheckpoint=%d" % WAL_AUTOCHECKPOINT_PAGES)
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class SettingsStore:
+    """
+    Persistent per-user settings.
+    `users` is the in-memory dict the handlers read and mutate. After changing
+    a user's settings call save_user() to write the row immediately, or
+    mark_dirty() to have it written by the background flusher. Call
+    poll_changes() to pick up rows written by other processes, and
+    add_listener() to hear about saves made in this process.
+    """
+
+    def __init__(self, path: str = DB_FILE):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_settings ("
+            " user_id TEXT PRIMARY KEY,"
+            " data TEXT NOT NULL,"
+            " seq INTEGER NOT NULL DEFAULT 0)"
+        )
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(user_settings)")]
+        if "seq" not in columns:
+            self.conn.execute("ALTER TABLE user_settings ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS user_settings_seq ON user_settings (seq)")
+        # Change feed position: highest seq applied to `users`, the last
+        # data_version seen, and the seq of this store's own latest write per user.
+        self.cursor = 0
+        self._data_version = None
+        self._own_seq = {}
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+        self._dirty = threading.Event()
+        self._stopping = False
+        self._last_compact = time.monotonic()
+        self.listeners = []
+        self._import_legacy_file()
+        self.users = self.load_all()
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="settings-flusher", daemon=True
+        )
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def _import_legacy_file(self):
+        """Copy users from user_settings.json into an empty database."""
+        if not os.path.exists(LEGACY_SETTINGS_FILE):
+            return
+        with self.lock:
+            if self.conn.execute("SELECT 1 FROM user_settings LIMIT 1").fetchone():
+                return
+            try:
+                with open(LEGACY_SETTINGS_FILE, "r") as file:
+                    legacy = json.load(file)
+            except (OSError, ValueError) as e:
+                logger.error("Could not import %s: %s", LEGACY_SETTINGS_FILE, e)
+                return
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO user_settings (user_id, data, seq) VALUES (?, ?, ?)",
+                [
+                    (user_id, json.dumps(settings), seq)
+                    for seq, (user_id, settings) in enumerate(legacy.items(), 1)
+                ],
+            )
+            self.conn.execute("COMMIT")
+        logger.info("Imported %d users from %s", len(legacy), LEGACY_SETTINGS_FILE)
+
+    def load_all(self) -> dict:
+        """Load every user's settings from the database."""
+        with self.lock:
+            self._data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            rows = self.conn.execute("SELECT user_id, data, seq FROM user_settings").fetchall()
+        self.cursor = max((seq for _, _, seq in rows), default=0)
+        return {user_id: json.loads(data) for user_id, data, _ in rows}
+
+    def _upsert(self, user_id: str, data: str):
+        """Write one user's row; the caller holds the lock."""
+        (seq,) = self.conn.execute(UPSERT_SQL, (user_id, data)).fetchone()
+        self._own_seq[user_id] = seq
+
+    def add_listener(self, callback):
+        """
+        Call `callback(user_ids)` whenever a user's settings are saved in this
+        process. Saves from other processes are reported by poll_changes().
+        """
+        self.listeners.append(callback)
+
+    def _notify(self, user_id: str):
+        for callback in self.listeners:
+            try:
+                callback([user_id])
+            except Exception as e:
+                logger.error("Settings listener failed for user %s: %s", user_id, e)
+
+    def save_user(self, user_id: str, settings: dict):
+        """Insert or replace the row for a single user."""
+        data = json.dumps(settings)
+        with self.lock:
+            self._upsert(user_id, data)
+        self._notify(user_id)
+
+    def update_fields(self, user_id: str, **fields):
+        """
+        Update individual fields of a stored user without touching the rest of
+        the row, so concurrent changes to other fields are not overwritten.
+        """
+        assignments = ", ".join("'$.%s', json(?)" % field for field in fields)
+        values = [json.dumps(value) for value in fields.values()]
+        with self.lock:
+            row = self.conn.execute(
+                "UPDATE user_settings SET data = json_set(data, " + assignments + "), "
+                "seq = " + NEXT_SEQ + " WHERE user_id = ? RETURNING seq",
+                values + [user_id],
+            ).fetchone()
+            if row:
+                self._own_seq[user_id] = row[0]
+
+    def poll_changes(self) -> list:
+        """
+        Apply rows written by other processes since the last poll to `users`
+        and return the ids of the users that changed.
+        This is cheap when nothing changed: SQLite's data_version only moves
+        when another connection commits. Existing settings dicts are updated in
+        place so references held by callers (including running repost jobs)
+        stay valid, and users with changes still queued locally are left alone.
+        """
+        with self.lock:
+            version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+            if version == self._data_version:
+                return []
+            self._data_version = version
+            rows = self.conn.execute(
+                "SELECT user_id, data, seq FROM user_settings WHERE seq > ? ORDER BY seq",
+                (self.cursor,),
+            ).fetchall()
+            own_seq = dict(self._own_seq)
+        with self.pending_lock:
+            pending = set(self.pending)
+        changed = []
+        for user_id, data, seq in rows:
+            self.cursor = max(self.cursor, seq)
+            settings = json.loads(data)
+            current = self.users.get(user_id)
+            if own_seq.get(user_id) == seq or user_id in pending:
+                # Our own write, or local changes still queued: keep the local
+                # copy, but pick up the scheduler's fields, which a save here
+                # carried over from a row this process has not read.
+                if current is not None and merge_scheduler_fields(current, settings):
+                    changed.append(user_id)
+                continue
+            if current is not None:
+                # update() first so concurrent readers never see a missing key
+                current.update(settings)
+                for key in set(current) - set(settings):
+                    del current[key]
+            else:
+                self.users[user_id] = settings
+            changed.append(user_id)
+        if changed:
+            logger.info("Picked up settings changes for %d user(s)", len(changed))
+        return changed
+
+    def mark_dirty(self, user_id: str, settings: dict):
+        """
+        Queue a user's settings for the next background flush.
+        The settings are snapshotted now, so later changes from the handlers
+        cannot race the flusher; repeated calls before a flush overwrite the
+        queued snapshot and cost a single write.
+        """
+        data = json.dumps(settings)
+        with self.pending_lock:
+            self.pending[user_id] = data
+        self._dirty.set()
+        self._notify(user_id)
+
+    def flush(self):
+        """Write all queued user settings in a single transaction."""
+        with self.pending_lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return
+        try:
+            with self.lock:
+                self.conn.execute("BEGIN")
+                try:
+                    for user_id, data in batch.items():
+                        self._upsert(user_id, data)
+                    self.conn.execute("COMMIT")
+                except sqlite3.Error:
+                    self.conn.execute("ROLLBACK")
+                    raise
+        except sqlite3.Error:
+            # Put the batch back unless a newer snapshot was queued meanwhile.
+            with self.pending_lock:
+                for user_id, data in batch.items():
+                    self.pending.setdefault(user_id, data)
+            raise
+        logger.debug("Flushed settings for %d user(s)", len(batch))
+
+    def compact(self):
+        """Checkpoint the WAL into the database file and truncate it."""
+        with self.lock:
+            busy, log_pages, moved = self.conn.execute(
+                "PRAGMA wal_checkpoint(TRUNCATE)"
+            ).fetchone()
+        self._last_compact = time.monotonic()
+        if busy:
+            logger.debug("Checkpoint incomplete, %d/%d pages moved", moved, log_pages)
+
+    def _flush_loop(self):
+        """
+        Background thread: flush shortly after the first queued change and
+        compact the WAL every COMPACT_INTERVAL seconds.
+        """
+        while not self._stopping:
+            if self._dirty.wait(timeout=COMPACT_INTERVAL):
+                if self._stopping:
+                    break
+                time.sleep(FLUSH_INTERVAL)
+                self._dirty.clear()
+                try:
+                    self.flush()
+                except sqlite3.Error as e:
+                    logger.error("Failed to flush settings: %s", e)
+            if time.monotonic() - self._last_compact >= COMPACT_INTERVAL:
+                try:
+                    self.compact()
+                except sqlite3.Error as e:
+                    logger.error("Failed to compact settings database: %s", e)
+
+    def close(self):
+        """Flush queued changes and compact; called automatically at exit."""
+        self._stopping = True
+        self._dirty.set()
+        self.flush()
+        self.compact()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store() -> SettingsStore:
+    """Return the process-wide settings store, opening it on first use."""
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = SettingsStore()
+        return _store
@@ -0,0 +1,106 @@
+"""
+upload_ledger.py - Ledger of Uploads to Destination Accounts
+-------------------------------------------------------------
+An upload can time out after Instagram has already accepted the post; a
+blind retry would then post it twice. This module keeps a ledger per
+(user, source, media):
+- The intent to upload (with the caption and time) is recorded before the
+  upload starts.
+- The destination media id is recorded once the upload returns.
+An intent without a destination id means an earlier attempt ended in an
+unknown state; the caller reconciles it against the destination account's
+latest posts before uploading again.
+"""
+
+import time
+import logging
+import threading
+from storage import DB_FILE, connect
+
+logger = logging.getLogger(__name__)
+
+# Seconds confirmed uploads are kept in the ledger.
+LEDGER_RETENTION = 30 * 24 * 60 * 60
+
+
+class UploadLedger:
+    """Persistent record of upload intents and their destination media ids."""
+
+    def __init__(self, path: str = DB_FILE):
+        self.lock = threading.Lock()
+        self.conn = connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS upload_ledger ("
+            " user_id TEXT NOT NULL,"
+            " source TEXT NOT NULL,"
+            " media_pk TEXT NOT NULL,"
+            " caption TEXT NOT NULL,"
+            " started_at REAL NOT NULL,"
+            " dest_media_pk TEXT,"
+            " PRIMARY KEY (user_id, source, media_pk)"
+            ") WITHOUT ROWID"
+        )
+
+    def confirmed(self, user_id: str, source: str, media_pk):
+        """Return the destination media id of a confirmed upload, or None."""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT dest_media_pk FROM upload_ledger "
+                "WHERE user_id = ? AND source = ? AND media_pk = ? AND dest_media_pk IS NOT NULL",
+                (user_id, source, str(media_pk)),
+            ).fetchone()
+        return row[0] if row else None
+
+    def unconfirmed(self, user_id: str, source: str, media_pk):
+        """Return (caption, started_at) of an upload started but never confirmed, or None."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT caption, started_at FROM upload_ledger "
+                "WHERE user_id = ? AND source = ? AND media_pk = ? AND dest_media_pk IS NULL",
+                (user_id, source, str(media_pk)),
+            ).fetchone()
+
+    def begin(self, user_id: str, source: str, media_pk, caption: str):
+        """Record the intent to upload a media item, before the upload starts."""
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO upload_ledger (user_id, source, media_pk, caption, started_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(user_id, source, media_pk) DO UPDATE SET "
+                "caption = excluded.caption, started_at = excluded.started_at, dest_media_pk = NULL",
+                (user_id, source, str(media_pk), caption, time.time()),
+            )
+
+    def confirm(self, user_id: str, source: str, media_pk, dest_media_pk):
+        """Record the destination media id of a finished upload."""
+        with self.lock:
+            self.conn.execute(
+                "UPDATE upload_ledger SET dest_media_pk = ? "
+                "WHERE user_id = ? AND source = ? AND media_pk = ?",
+                (str(dest_media_pk), user_id, source, str(media_pk)),
+            )
+
+    def abandon(self, user_id: str, source: str, media_pk):
+        """Drop an unconfirmed intent for an upload known never to have started."""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM upload_ledger "
+                "WHERE user_id = ? AND source = ? AND media_pk = ? AND dest_media_pk IS NULL",
+                (user_id, source, str(media_pk)),
+            )
+
+    def is_recorded(self, user_id: str, dest_media_pk) -> bool:
+        """Return True if a destination post is already accounted for by another upload."""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT 1 FROM upload_ledger WHERE user_id = ? AND dest_media_pk = ?",
+                (user_id, str(dest_media_pk)),
+            ).fetchone() is not None
+
+    def purge(self, retention: float = LEDGER_RETENTION):
+        """Delete confirmed uploads started more than `retention` seconds ago."""
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM upload_ledger WHERE dest_media_pk IS NOT NULL AND started_at < ?",
+                (time.time() - retention,),
+            )